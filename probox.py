@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import argparse, sys, os, signal, json, subprocess, tempfile, socket, random, getpass, grp, tomllib
+import argparse, sys, os, re, fnmatch, fcntl, signal, select, struct, termios, tty, json, subprocess, tempfile, socket, random, getpass, shutil, tarfile, hashlib, time, threading, socketserver, http.client, http.server, contextlib, urllib.parse, urllib.request, urllib.error, concurrent.futures, tomllib
 from pathlib import Path
 
 # TODO: automatic error handling?
@@ -41,11 +41,77 @@ from pathlib import Path
 START = '\033[1;33m>>>'
 END = '\033[0m\n'
 GENERIC_NAMES = {'src', 'source', 'project', 'dir', 'folder', 'git', 'repo', 'repository', 'code'}
+# Can point to a stand-in podman that records and simulates calls, see tests.md
+podman_binary = os.getenv('PROBOX_PODMAN', 'podman')
 
 default_config_file = """
 default_image = "docker.io/evertheylen/arch-with-code-server"
 # All contents of this directory will be pushed into the home directory of the container
 #home_overlay = "/home/foobar/configs/"
+# "copy" copies the overlay files into new containers, `probox overlay push/pull` syncs changes. "mount" bind
+# mounts each file read-only instead: nothing is copied and host changes show up right away, but the files
+# can't be edited in the container. Files added to home_overlay later on are still copied by push. A mount
+# sticks to the file that was there when the box started: editors that save by renaming a new file over the
+# old one only reach the box after a restart (`probox overlay push` lists such files).
+#overlay_mode = "copy"
+# Extra base images to keep up to date with `probox image refresh` (default_image is always included)
+#images = ["docker.io/library/archlinux"]
+# Image store (true for a default location, or a path) that the nested podman of every new box can use
+# read-only, so common images are only pulled once. Fill it with `probox store pull <image>`, which runs podman
+# in a throwaway box of default_image so the files get the IDs the boxes expect.
+#pinp_image_store = true
+# Storage driver of the nested podman in new boxes: "overlay" (native, needs a recent kernel), "fuse-overlayfs"
+# or "vfs" (slow, but works everywhere). Unset lets podman choose. Compare them with `probox bench pinp`.
+#pinp_storage_driver = "overlay"
+# Where `probox snapshot` stores its snapshots. Keep it on the same (btrfs/XFS) filesystem as the boxes
+# and projects so snapshots are reflinks instead of copies. Boxes whose project holds this directory (or
+# probox's or podman's data, like a box for the home directory) need --no-project.
+#snapshot_dir = "/home/foobar/.local/share/probox/snapshots"
+# Paths whose changes `probox upgrade` doesn't carry over to the new container (package manager files etc.)
+#upgrade_ignore = ["/usr", "/var/lib/pacman", "/var/cache", "/var/log", "/var/tmp", "/tmp", "/run"]
+# Seconds after which `probox du` and `ls --size` measure again (in the background)
+#size_cache_ttl = 600
+# `probox idle` stops (or pauses) running containers after this many seconds without exec sessions,
+# connections to their ports or CPU usage above idle_cpu_percent. 0 means never, see also [idle_timeouts].
+# idle_action is "stop", "pause" or "checkpoint".
+#idle_timeout = 3600
+#idle_action = "stop"
+#idle_cpu_percent = 2
+# Query podman through the socket of `podman system service` (e.g. `systemctl --user enable --now podman.socket`)
+# instead of running the podman binary. Either true (default socket) or a path. Falls back to the binary.
+#podman_socket = true
+# Run a small agent (needs python3 in the image) in new boxes, so `probox run` can skip the overhead of
+# `podman exec`. Compare both with `probox bench exec <box>`.
+#exec_agent = true
+
+# Keep started containers ready for `probox temp`, per base image
+#[temp_pool]
+#size = 2
+#images = ["docker.io/evertheylen/arch-with-code-server"]
+
+# Caches shared by all new containers: name = path in the container (~ is your home directory). Boxes write
+# to them at the same time, so only share caches whose tool copes with that by itself (pip and npm write
+# entries atomically, pacman downloads to temporary files). Not cargo: its lock is ~/.cargo/.package-cache,
+# outside the registry, and the rest of ~/.cargo holds installed tools and credentials.
+#[caches]
+#pacman = "/var/cache/pacman/pkg"
+#pip = "~/.cache/pip"
+#npm = "~/.npm"
+
+# Per-container idle timeouts in seconds, overriding idle_timeout
+#[idle_timeouts]
+#some-container = 7200
+
+# Short-lived access tokens for tools in new containers matching `boxes`, while the secrets stay on the host:
+#   export DIGITALOCEAN_ACCESS_TOKEN=$(curl -sf --unix-socket ~/tokens.sock http://localhost/digitalocean)
+# Tokens are cached and refreshed refresh_margin seconds before they expire. For digitalocean, secrets_file is
+# what `digitalocean_auth.py setup` writes.
+#[tokens.digitalocean]
+#provider = "digitalocean"
+#boxes = ["*"]
+#secrets_file = "~/.config/probox/digitalocean.secrets.json"
+#token_url = "https://cloud.digitalocean.com/v1/oauth/token"
+#refresh_margin = 300
 """
 
 
@@ -56,23 +122,164 @@ def status(*text):
     print(START, *text, end=END, file=sys.stderr)
 
 
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+podman_api = threading.local()
+
+
+def podman_api_path(args):
+    # Translates the (read-only) podman commands we use into libpod REST API paths, or None if unsupported
+    args = list(args)
+    positional, params, filters = [], {}, {}
+    while args:
+        arg = args.pop(0)
+        if arg == '--all':
+            params['all'] = 'true'
+        elif arg == '--filter':
+            key, _, value = args.pop(0).partition('=')
+            filters.setdefault(key, []).append(value)
+        elif arg.startswith('-'):
+            return None
+        else:
+            positional.append(arg)
+
+    match positional:
+        case ['container', 'ls'] | ['ps']:
+            path = '/containers/json'
+        case ['image', 'ls']:
+            path = '/images/json'
+        case ['image', 'ls', reference]:
+            path = '/images/json'
+            filters['reference'] = [reference]
+        case ['container' | 'image' as kind, 'inspect', name] if not params and not filters:
+            return f'/v4.0.0/libpod/{kind}s/{urllib.parse.quote(name, safe="")}/json'
+        case _:
+            return None
+    if filters:
+        params['filters'] = json.dumps(filters)
+    return f'/v4.0.0/libpod{path}' + (f'?{urllib.parse.urlencode(params)}' if params else '')
+
+
+def capture_podman_api(args):
+    # Returns None when the API can't be used, so the caller falls back to the podman binary
+    socket_path = config.get('podman_socket') if config else None
+    if not socket_path or getattr(podman_api, 'disabled', False):
+        return None
+    if socket_path is True:
+        socket_path = os.path.join(os.getenv("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}"), 'podman/podman.sock')
+    path = podman_api_path(args)
+    if path is None:
+        return None
+
+    # One persistent connection per thread, reconnected once if the service closed it
+    start = time.monotonic()
+    for attempt in range(2):
+        if getattr(podman_api, 'connection', None) is None:
+            podman_api.connection = UnixHTTPConnection(socket_path)
+        try:
+            podman_api.connection.request('GET', path)
+            response = podman_api.connection.getresponse()
+            body = response.read()
+            break
+        except (OSError, http.client.HTTPException):
+            podman_api.connection.close()
+            podman_api.connection = None
+    else:
+        status(f"Can't reach podman service at {socket_path}, falling back to podman binary")
+        podman_api.disabled = True
+        return None
+
+    if trace_started is not None:
+        record_trace(f'GET {path}'[:60], 'api', start, threading.get_native_id(), argv=list(args), returncode=response.status)
+    if response.status != 200:
+        # Let the binary produce the proper error
+        return None
+    data = json.loads(body)
+    return [data] if 'inspect' in args else data
+
+
 def capture_podman(*args, format_json=True):
-    res = subprocess.run(['podman', *args, *(['--format', 'json'] if format_json else [])], capture_output=True, text=True, check=True)
+    if format_json:
+        data = capture_podman_api(args)
+        if data is not None:
+            return data
+    res = subprocess.run([podman_binary, *args, *(['--format', 'json'] if format_json else [])], capture_output=True, text=True, check=True)
     return json.loads(res.stdout)
 
 
 def run_podman(*args, check=True, quiet=False, **kwargs):
-    command = ['podman', *args]
+    command = [podman_binary, *args]
     status(' '.join(command))
     if quiet:
         kwargs['stdout'] = subprocess.DEVNULL
     return subprocess.run(command, check=check, text=True, **kwargs)
 
 
-def get_containers():
+def probox_runtime_dir():
+    return Path(os.getenv("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}")) / 'probox'
+
+
+def podman_storage_dir():
+    return Path(os.getenv("XDG_DATA_HOME", Path.home() / ".local/share")) / 'containers/storage'
+
+
+def podman_state_key():
+    # Podman writes to its database whenever a container is created, removed, started or stopped, so these
+    # files tell us whether a cached `container ls` is still valid. Not just the mtime, two writes can fall in
+    # one timestamp tick (the WAL grows on every commit, a replaced file gets a new inode).
+    storage = podman_storage_dir()
+    key = []
+    for file in ['db.sql', 'db.sql-wal', 'libpod/bolt_state.db', 'overlay-containers/containers.json']:
+        try:
+            st = (storage / file).stat()
+            key.append([file, st.st_mtime_ns, st.st_size, st.st_ino])
+        except FileNotFoundError:
+            pass
+    return key or None
+
+
+def list_containers():
+    key = podman_state_key()
+    cache_file = probox_runtime_dir() / 'containers.json'
+    if key is not None:
+        try:
+            cached = json.loads(cache_file.read_text())
+            if cached['key'] == key:
+                return cached['containers']
+        except (OSError, ValueError, KeyError):
+            pass
+
     containers = capture_podman('container', 'ls', '--all', '--filter', 'label=probox.project_path')
-    containers_by_path = {Path(c['Labels']['probox.project_path']): c for c in containers}
+    if key is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f'.{os.getpid()}-{threading.get_ident()}')
+        tmp_file.write_text(json.dumps({'key': key, 'containers': containers}))
+        tmp_file.replace(cache_file)
+    return containers
+
+
+def is_running(container):
+    return container['State'] == 'running'
+
+
+def get_containers():
+    containers = list_containers()
     containers_by_name = {c['Names'][0]: c for c in containers}
+
+    def superseded(c):
+        # Kept by `upgrade --keep-old`, with the path of the upgraded box, which is the one the path stands for
+        successor = containers_by_name.get(c['Names'][0].removesuffix('-preupgrade'))
+        return successor not in (None, c) and successor['Labels']['probox.project_path'] == c['Labels']['probox.project_path']
+
+    containers_by_path = {Path(c['Labels']['probox.project_path']): c for c in containers if not superseded(c)}
     return containers_by_path, containers_by_name
 
 
@@ -99,34 +306,273 @@ def suggest_name(path, _taken):
         i += 1
 
 
+def probox_lock(name):
+    # Lock file shared by all probox processes, flock it and close it to release
+    path = probox_config_dir() / 'locks' / f'{name}.lock'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return open(path, 'w')
+
+
+def reserve_name(proj_path, name, taken):
+    # Returns the (suggested) name and the locked reservations of it and of the path, held by a create until
+    # podman knows them. Close the returned ExitStack to release them.
+    locks_dir = probox_config_dir() / 'locks'
+    with probox_lock('names') as names_lock:
+        fcntl.flock(names_lock, fcntl.LOCK_EX)
+        reserved = set()
+        for path in [*locks_dir.glob('name-*.lock'), *locks_dir.glob('path-*.lock')]:
+            with open(path) as reservation:
+                try:
+                    fcntl.flock(reservation, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    path.unlink()  # left by a finished create
+                except BlockingIOError:
+                    reserved.add(path.stem)
+
+        name = name or suggest_name(proj_path, set(taken) | {r.removeprefix('name-') for r in reserved})
+        if '.' in name or '/' in name:
+            status("Name can't contain . or /")
+            sys.exit(1)
+        if f'name-{name}' in reserved:
+            status(f"Another probox is already creating {name}")
+            sys.exit(1)
+        path_key = 'path-' + hashlib.sha256(str(proj_path).encode()).hexdigest()[:16]
+        if path_key in reserved:
+            status(f"Another probox is already creating a container for {proj_path}")
+            sys.exit(1)
+        reservation = contextlib.ExitStack()
+        for key in [f'name-{name}', path_key]:
+            fcntl.flock(reservation.enter_context(probox_lock(key)), fcntl.LOCK_EX)
+        return name, reservation
+
+
 def ssh_agent_socket(name):
     return f'/run/user/{os.getuid()}/{name}-ssh.sock'
 
 
+def ssh_agent_pidfile(name):
+    return Path(f'/run/user/{os.getuid()}/{name}-ssh.pid')
+
+
+def socket_alive(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(1)
+        try:
+            s.connect(str(path))
+            return True
+        except OSError:
+            return False
+
+
 def ssh_agent_pid(name):
-    processes = subprocess.run(['pgrep', '-f', f'ssh-agent -a {ssh_agent_socket(name)}'], capture_output=True, text=True)
-    pid_str = processes.stdout.strip()
-    if pid_str != '':
-        return int(pid_str)
-    else:
-        return None
+    # Returns the pid of the box's agent if it is alive (which we know by connecting to its socket), and
+    # cleans up after agents that crashed
+    sock, pidfile = Path(ssh_agent_socket(name)), ssh_agent_pidfile(name)
+    try:
+        pid = int(pidfile.read_text())
+    except (FileNotFoundError, ValueError):
+        pid = None
+
+    if socket_alive(sock):
+        if pid is None:
+            # Agent started by an older probox, adopt it
+            processes = subprocess.run(['pgrep', '-f', f'ssh-agent -a {sock}'], capture_output=True, text=True)
+            pid = int(processes.stdout.split()[0]) if processes.stdout.strip() else None
+            if pid is not None:
+                pidfile.write_text(str(pid))
+        return pid
+
+    pidfile.unlink(missing_ok=True)
+    if sock.exists():
+        status(f"Removing stale ssh-agent socket {sock}")
+        sock.unlink()
+    return None
 
 
 def start_ssh_agent(name):
     pid = ssh_agent_pid(name)
     if pid is None:
         status("Starting ssh-agent")
-        subprocess.run(['ssh-agent', '-a', ssh_agent_socket(name)], stdout=subprocess.DEVNULL, check=True)
+        output = subprocess.run(['ssh-agent', '-s', '-a', ssh_agent_socket(name)], capture_output=True, text=True, check=True).stdout
+        ssh_agent_pidfile(name).write_text(re.search(r'SSH_AGENT_PID=(\d+)', output).group(1))
 
 
 def stop_ssh_agent(name):
     pid = ssh_agent_pid(name)
     if pid is not None:
         os.kill(pid, signal.SIGTERM)
+        ssh_agent_pidfile(name).unlink(missing_ok=True)
     else:
         status("No ssh-agent found")
 
 
+def write_private(path, text):
+    # Written next to the file and renamed, so readers never see half a file
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}-{threading.get_ident()}')
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def oauth_refresh(token_url, fields):
+    request = urllib.request.Request(token_url, data=urllib.parse.urlencode(fields).encode(), method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            data = json.load(response)
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"{token_url} answered {e.code}: {e.read().decode(errors='replace')}")
+    if 'access_token' not in data:
+        raise RuntimeError(f"{token_url} gave no access token: {data}")
+    return data
+
+
+def digitalocean_token(settings):
+    # The refresh flow of digitalocean_auth.py. Every refresh rotates the refresh token, so it's saved right away.
+    secrets_file = Path(settings.get('secrets_file', probox_config_dir() / 'digitalocean.secrets.json')).expanduser()
+    secrets = json.loads(secrets_file.read_text())
+    data = oauth_refresh(settings.get('token_url', 'https://cloud.digitalocean.com/v1/oauth/token'), {
+        'grant_type': 'refresh_token',
+        'client_id': secrets['CLIENT_ID'],
+        'client_secret': secrets['CLIENT_SECRET'],
+        'refresh_token': secrets['REFRESH_TOKEN'],
+    })
+    secrets['REFRESH_TOKEN'] = data['refresh_token']
+    write_private(secrets_file, json.dumps(secrets, indent=4))
+    return data['access_token'], data.get('expires_in', 3600)
+
+
+# Providers take the token's settings from the config and return a fresh access token and its lifetime in seconds
+token_providers = {
+    'digitalocean': digitalocean_token,
+}
+
+
+def token_cache_file(token):
+    return probox_runtime_dir() / 'tokens' / f'{token}.json'
+
+
+def cached_token(token):
+    # The cached token, or None if it's missing or (almost) expired
+    try:
+        entry = json.loads(token_cache_file(token).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    margin = config['tokens'][token].get('refresh_margin', 300)
+    return entry if entry['expires'] - time.time() > margin else None
+
+
+def get_token(token):
+    entry = cached_token(token)
+    if entry is not None:
+        return entry
+    # One refresh at a time for all boxes, as a refresh token only works once
+    with probox_lock(f'token-{token}') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entry = cached_token(token)
+        if entry is None:
+            settings = config['tokens'][token]
+            access_token, expires_in = token_providers[settings.get('provider', token)](settings)
+            entry = {'token': access_token, 'expires': time.time() + expires_in}
+            token_cache_file(token).parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            write_private(token_cache_file(token), json.dumps(entry))
+        return entry
+
+
+def box_tokens(name):
+    return [token for token, settings in config.get('tokens', {}).items() if any(fnmatch.fnmatch(name, pattern) for pattern in settings.get('boxes', []))]
+
+
+def token_broker_socket(name):
+    return Path(f'/run/user/{os.getuid()}/{name}-tokens.sock')
+
+
+def token_broker_pidfile(name):
+    return Path(f'/run/user/{os.getuid()}/{name}-tokens.pid')
+
+
+def token_broker_pid(name):
+    pidfile = token_broker_pidfile(name)
+    if pidfile.exists() and socket_alive(token_broker_socket(name)):
+        return int(pidfile.read_text())
+    return None
+
+
+def start_token_broker(name):
+    if token_broker_pid(name) is not None:
+        return
+    status("Starting token broker")
+    spawn_detached('token', 'serve', name)
+    for i in range(100):
+        if socket_alive(token_broker_socket(name)):
+            return
+        time.sleep(0.05)
+    status(f"Token broker didn't start, try `probox token serve {name}` to see why")
+    sys.exit(1)
+
+
+def stop_token_broker(name):
+    pid = token_broker_pid(name)
+    if pid is not None:
+        os.kill(pid, signal.SIGTERM)
+    token_broker_pidfile(name).unlink(missing_ok=True)
+
+
+def serve_tokens(name):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            token = self.path.strip('/')
+            if token not in box_tokens(name):
+                self.send_error(404, f"No token '{token}' for {name}")
+                return
+            try:
+                entry = get_token(token)
+            except Exception as e:
+                self.send_error(502, f"Refreshing {token} failed: {e}")
+                return
+            body = entry['token'].encode() + b'\n'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Expires-In', str(int(entry['expires'] - time.time())))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            return name
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    sock = token_broker_socket(name)
+    sock.unlink(missing_ok=True)
+    server = Server(str(sock), Handler)
+    os.chmod(sock, 0o600)
+    token_broker_pidfile(name).write_text(str(os.getpid()))
+    # Clean up like ssh-agent does when stopped
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        sock.unlink(missing_ok=True)
+
+
+def token(operation, name=None):
+    match operation:
+        case 'serve':
+            serve_tokens(name)
+        case 'get':
+            if name not in config.get('tokens', {}):
+                status(f"No [tokens.{name}] in config")
+                sys.exit(1)
+            print(get_token(name)['token'])
+        case 'ls':
+            rows = []
+            for token, settings in config.get('tokens', {}).items():
+                entry = cached_token(token)
+                expires = format_age(entry['expires'] - time.time()) if entry else '-'
+                rows.append([token, settings.get('provider', token), ', '.join(settings.get('boxes', [])), expires])
+            print_table(['TOKEN', 'PROVIDER', 'BOXES', 'EXPIRES IN'], rows)
+
+
 def parse_user_triple(triple_str):
     username, uid_s, gid_s = triple_str.split(':')
     return (username, int(uid_s), int(gid_s))
@@ -136,13 +582,138 @@ def stringify_user_triple(username, uid, gid):
     return f"{username}:{uid}:{gid}"
 
 
+def probox_config_dir():
+    return Path(os.getenv("XDG_CONFIG_HOME", Path.home() / ".config")) / 'probox'
+
+
+def probox_data_dir():
+    return Path(os.getenv("XDG_DATA_HOME", Path.home() / ".local/share")) / 'probox'
+
+
 def make_pinp_container_storage(container_id):
-    path = Path(os.getenv("XDG_DATA_HOME", Path.home() / ".local/share")) / 'probox' / container_id
+    path = probox_data_dir() / container_id
     path.mkdir(parents=True, exist_ok=True)
     return path
 
 
+def pinp_image_store():
+    # Image store shared (read-only) by the nested podman of every box, or None if not enabled
+    store = config.get('pinp_image_store')
+    if not store:
+        return None
+    store = probox_data_dir() / 'image-store' if store is True else Path(store).expanduser()
+    # Podman needs the lock files to exist, since it can't create them in a read-only store. Only in new
+    # directories: once filled, they belong to the root of the boxes (a subuid), which we can't look into.
+    for kind in ['overlay-images/images.lock', 'overlay-layers/layers.lock', 'vfs-images/images.lock', 'vfs-layers/layers.lock']:
+        if not (store / kind).parent.exists():
+            (store / kind).parent.mkdir(parents=True)
+            (store / kind).touch()
+    return store
+
+
+# Storage drivers for nested podman, with their storage.conf driver and overlay mount program
+pinp_drivers = {
+    'overlay': ('overlay', None),
+    'fuse-overlayfs': ('overlay', '/usr/bin/fuse-overlayfs'),
+    'vfs': ('vfs', None),
+}
+
+
+def make_pinp_storage_conf(pinp_storage_id, driver=None, image_store=True):
+    # Mounted as /etc/containers/storage.conf, which both rootful and rootless nested podman read.
+    # Without a driver, podman picks one by itself.
+    conf = ''
+    if driver is not None:
+        storage_driver, mount_program = pinp_drivers[driver]
+        conf += f'[storage]\ndriver = "{storage_driver}"\n'
+    if image_store:
+        conf += '[storage.options]\nadditionalimagestores = ["/var/lib/shared"]\n'
+    if driver is not None and mount_program is not None:
+        conf += f'[storage.options.overlay]\nmount_program = "{mount_program}"\n'
+    path = probox_data_dir() / f'{pinp_storage_id}-storage.conf'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(conf)
+    return path
+
+
+def image_store_podman(store, *args):
+    # Arguments for running the nested podman of a throwaway box on the store, as root and with the ID mapping
+    # of the boxes (keep-id). A `podman --root` on the host would use the host's rootless mapping instead, under
+    # which the files are shifted inside the boxes: root's files show up as the user's, and uid N's as N-1's.
+    driver = config.get('pinp_storage_driver')
+    conf_opts = []
+    if driver is not None:
+        conf_opts = ['--volume', f"{make_pinp_storage_conf('image-store', driver, False)}:/etc/containers/storage.conf:ro,Z"]
+    return [
+        'run', '--rm', '--userns=keep-id', '--user=root', '--device=/dev/fuse', '--security-opt', 'label=type:container_runtime_t',
+        '--volume', f"{store}:/var/lib/shared:z", *conf_opts,
+        config['default_image'], 'podman', '--root', '/var/lib/shared', *args
+    ]
+
+
+def image_store(operation, images=[]):
+    store = pinp_image_store()
+    if store is None:
+        status("No 'pinp_image_store' set in config, can't do anything")
+        sys.exit(1)
+
+    if operation == 'pull':
+        for image in images:
+            run_podman(*image_store_podman(store, 'pull', image))
+    elif operation == 'ls':
+        run_podman(*image_store_podman(store, 'image', 'ls'))
+    else:
+        # Without the store, every box using an image would keep its own copy
+        size = disk_usage(store).get(store, 0)
+        images = capture_podman(*image_store_podman(store, 'image', 'ls'))
+        boxes = [c for c in list_containers() if 'probox.pinp_image_store' in c['Labels']]
+        status(f"Store holds {len(images)} images ({format_size(size)}), shared by {len(boxes)} boxes: "
+               f"up to {format_size(size * max(len(boxes) - 1, 0))} deduplicated")
+
+
+def cache_dir(name):
+    return Path(os.getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / 'probox' / 'caches' / name
+
+
+def shared_cache_mount_opts():
+    # Each [caches] entry is one host directory mounted into every box. Lowercase z so all boxes can share
+    # it. Concurrent writers are left to the tools, which write their cache entries atomically.
+    opts = []
+    for name, container_path in config.get('caches', {}).items():
+        if container_path.startswith('~'):
+            container_path = str(Path.home() / container_path.removeprefix('~').lstrip('/'))
+        cache_dir(name).mkdir(parents=True, exist_ok=True)
+        opts.extend(['--volume', f"{cache_dir(name)}:{container_path}:z"])
+    return opts
+
+
+def disk_usage(*paths):
+    # Sizes in bytes, in `podman unshare` as boxes write files owned by subuids
+    res = subprocess.run([podman_binary, 'unshare', 'du', '-s', '--block-size=1', *map(str, paths)], capture_output=True, text=True)
+    return {Path(line.split('\t', 1)[1]): int(line.split('\t', 1)[0]) for line in res.stdout.splitlines()}
+
+
+def cache(operation, names=[], days=30):
+    names = names or list(config.get('caches', {}))
+    dirs = [cache_dir(name) for name in names if cache_dir(name).exists()]
+    before = disk_usage(*dirs) if dirs else {}
+    if operation == 'prune':
+        for d in dirs:
+            subprocess.run([podman_binary, 'unshare', 'find', str(d), '-type', 'f', '-atime', f'+{days}', '-delete'], check=True)
+        after = disk_usage(*dirs) if dirs else {}
+        status(f"Freed {format_size(sum(before.values()) - sum(after.values()))}")
+    else:
+        print_table(['CACHE', 'SIZE', 'MOUNTED AT'], [[d.name, format_size(before.get(d, 0)), config.get('caches', {}).get(d.name, '-')] for d in dirs])
+
+
 def image_with_user(from_image, username, uid, gid):
+    # Locked, so parallel creates (`probox apply`) build the image only once
+    with probox_lock('image-' + hashlib.sha256(from_image.encode()).hexdigest()[:16]) as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return build_image_with_user(from_image, username, uid, gid)
+
+
+def build_image_with_user(from_image, username, uid, gid):
     # Builds an image from a certain base image
     base_images = capture_podman('image', 'ls', '--all', from_image)
     if len(base_images) == 0:
@@ -189,78 +760,216 @@ def image_with_user(from_image, username, uid, gid):
         return image_id
 
 
-def create(*, path=None, name=None, from_image=None, privileged=False, push_overlay=True, ignore_post_create_cmd=False, ignore_existing_containers=False):
-    containers_by_path, containers_by_name = get_containers()
-    proj_path = Path(os.getcwd() if path is None else path).absolute()
-    if not ignore_existing_containers and proj_path in containers_by_path:
-        status("Path already registered!", containers_by_path[proj_path]['Names'][0])
-        sys.exit(1)
+def refresh_images(jobs=4):
+    # Pull every configured base image and prebuild its derived image, so `create` doesn't have to
+    images = list(dict.fromkeys([config['default_image'], *config.get('images', [])]))
 
-    name = name or suggest_name(proj_path, containers_by_name.keys())
-    if name is None:
-        status("Couldn't determine a name from the path. Specify a name with --name.")
-        sys.exit(1)
-    if '.' in name or '/' in name:
-        status("Name can't contain . or /")
+    def refresh(image):
+        run_podman('pull', '--quiet', image, quiet=True)
+        return image_with_user(image, getpass.getuser(), os.getuid(), os.getgid())
+
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {image: pool.submit(refresh, image) for image in images}
+        for image, future in futures.items():
+            try:
+                future.result()
+            except (subprocess.CalledProcessError, SystemExit):
+                status(f"Refreshing {image} failed")
+                failed = True
+
+    gc_images()
+    if failed:
         sys.exit(1)
 
-    basic_create_options = ['--name', name, '--hostname', name, '--tz=local']
 
+def gc_images():
+    # Derived images are stale once their parent is gone or no longer tagged (i.e. replaced by a newer pull)
+    free_before = shutil.disk_usage(podman_storage_dir()).free
+    images = capture_podman('image', 'ls', '--all')
+    images_by_id = {i['Id']: i for i in images}
+    used = {c['ImageID'] for c in capture_podman('container', 'ls', '--all')}
+
+    stale_parents = set()
+    for image in images:
+        parent_id = (image.get('Labels') or {}).get('probox.parent_image')
+        if parent_id is None or image['Id'] in used:
+            continue
+        parent = images_by_id.get(parent_id)
+        if parent is None or not parent.get('Names'):
+            if run_podman('image', 'rm', image['Id'], check=False, quiet=True).returncode == 0 and parent is not None:
+                stale_parents.add(parent_id)
+
+    # Old base images go too, unless something else still depends on them (podman refuses that)
+    for parent_id in stale_parents - used:
+        run_podman('image', 'rm', parent_id, check=False, quiet=True, stderr=subprocess.DEVNULL)
+
+    reclaimed = shutil.disk_usage(podman_storage_dir()).free - free_before
+    status(f"Reclaimed {format_size(max(reclaimed, 0))}")
+
+
+def timed(timings, stage, func, *args, **kwargs):
+    start = time.monotonic()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[stage] = time.monotonic() - start
+
+
+def create(*, path=None, name=None, from_image=None, privileged=False, push_overlay=True, ignore_post_create_cmd=False, ignore_existing_containers=False, pinp_storage_id=None, pool=False, pinp_driver=None, features_from=None):
+    # features_from: inspect data of a container (being upgraded) whose exec agent, tokens and image store
+    # settings to keep, instead of taking them from the config
     if from_image is None:
         from_image = config['default_image']
 
-    image_id = image_with_user(from_image, getpass.getuser(), os.getuid(), os.getgid())
-
-    # Maybe look at https://github.com/containers/podman/discussions/13728#discussioncomment-2900471 ?
-    # In particular, this comment says something like using --userns=auto "with a huge /etc/subuid range"
-    # Already did the subuid thing via
-    #   sudo usermod --add-subuids 1000000-990000000 --add-subgids 1000000-990000000 evert
-    # But then mapping the volume is impossible (I'd use `:idmap=uids=1000-1000-1;gids=1000-1000-1`), see https://github.com/containers/crun/issues/1632
+    pinp_driver = pinp_driver or config.get('pinp_storage_driver')
+    if pinp_driver is not None and pinp_driver not in pinp_drivers:
+        status(f"Unknown PINP storage driver '{pinp_driver}', choose from:", ', '.join(pinp_drivers))
+        sys.exit(1)
 
-    start_ssh_agent(name)
+    started = time.monotonic()
+    timings = {}
+    proj_path = Path(os.getcwd() if path is None else path).absolute()
+    taken = []
+    if not (ignore_existing_containers and name):
+        containers_by_path, containers_by_name = timed(timings, 'containers', get_containers)
+        if not ignore_existing_containers and proj_path in containers_by_path:
+            status("Path already registered!", containers_by_path[proj_path]['Names'][0])
+            sys.exit(1)
+        taken = containers_by_name.keys()
+
+    name, reservation = reserve_name(proj_path, name, taken)
+    # Held until podman knows the name and path, so parallel creates can't pick them too
+    with reservation:
+        if not ignore_existing_containers:
+            # Registered by a create that finished after we looked (the list is cached, so this is usually free)
+            existing = get_containers()[0].get(proj_path)
+            if existing is not None:
+                status("Path already registered!", existing['Names'][0])
+                sys.exit(1)
+
+        # Only now that the cheap checks passed, so exiting on them doesn't have to wait for a pull or build.
+        # The derived image only depends on the base image, so it is looked up (or built) while we do the rest.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        image_future = executor.submit(timed, timings, 'image', image_with_user, from_image, getpass.getuser(), os.getuid(), os.getgid())
+
+        basic_create_options = ['--name', name, '--hostname', name, '--tz=local']
+
+        # Maybe look at https://github.com/containers/podman/discussions/13728#discussioncomment-2900471 ?
+        # In particular, this comment says something like using --userns=auto "with a huge /etc/subuid range"
+        # Already did the subuid thing via
+        #   sudo usermod --add-subuids 1000000-990000000 --add-subgids 1000000-990000000 evert
+        # But then mapping the volume is impossible (I'd use `:idmap=uids=1000-1000-1;gids=1000-1000-1`), see https://github.com/containers/crun/issues/1632
+
+        if features_from is None:
+            use_tokens, use_exec_agent, image_store_dir = bool(box_tokens(name)), config.get('exec_agent'), pinp_image_store()
+        else:
+            labels = features_from['Config']['Labels']
+            use_tokens, use_exec_agent = 'probox.tokens' in labels, 'probox.exec_agent' in labels
+            mounts = {m['Destination']: m['Source'] for m in features_from['Mounts']}
+            image_store_dir = mounts.get('/var/lib/shared') if 'probox.pinp_image_store' in labels else None
+
+        agent_future = executor.submit(timed, timings, 'ssh-agent', start_ssh_agent, name)
+        broker_future = executor.submit(timed, timings, 'token-broker', start_token_broker, name) if use_tokens else None
+
+        if not privileged and Path.home() != proj_path:
+            # see https://github.com/containers/podman/discussions/25335#discussioncomment-12237404
+            # TODO: allow PINP while keeping SELinux active!
+            # Current trade-off solution: label as container?
+            proj_dir_mount_opts = [
+                # Pool boxes get their project mounted later on, through this (shared) mount
+                '--volume', f'{proj_path}:{proj_path}:Z' + (',rshared' if pool else ''),
+                '--security-opt', 'label=type:container_runtime_t',
+            ]
+        else:
+            # fallback to not kill a users home directory (docs require us to do it)
+            proj_dir_mount_opts = ['--volume', f'{proj_path}:{proj_path}']
+            if not privileged:
+                status("WARNING: home dir is selected as main directory, disabling SELinux!")
+                proj_dir_mount_opts.extend(['--security-opt', 'label=disable'])
+
+        pinp_storage_id = pinp_storage_id or name + '-' + ''.join(random.choice('0123456789ABCDEF') for i in range(6))
+        storage_future = executor.submit(timed, timings, 'storage', lambda: (
+            make_pinp_container_storage(pinp_storage_id),
+            make_pinp_container_storage(pinp_storage_id + '-' + getpass.getuser()),
+        ))
+
+        pinp_opts = []
+        if image_store_dir is not None:
+            pinp_opts += [
+                '--label', 'probox.pinp_image_store=1',
+                '--volume', f"{image_store_dir}:/var/lib/shared:ro,z",  # shared by all boxes, so lowercase z
+            ]
+        if pinp_driver is not None:
+            pinp_opts += ['--label', f'probox.pinp_driver={pinp_driver}']
+        if image_store_dir is not None or pinp_driver is not None:
+            storage_conf = make_pinp_storage_conf(pinp_storage_id, pinp_driver, image_store_dir is not None)
+            pinp_opts += ['--volume', f"{storage_conf}:/etc/containers/storage.conf:ro,Z"]
+
+        mounted_overlay = overlay_mount_files()
+        overlay_mount_opts = [
+            # The same host files for all boxes, so lowercase z
+            opt for relfile in mounted_overlay for opt in ['--volume', f"{Path(config['home_overlay']) / relfile}:{Path.home() / relfile}:ro,z"]
+        ]
 
-    if not privileged and Path.home() != proj_path:
-        # see https://github.com/containers/podman/discussions/25335#discussioncomment-12237404
-        # TODO: allow PINP while keeping SELinux active!
-        # Current trade-off solution: label as container?
-        proj_dir_mount_opts = [
-            '--volume', f'{proj_path}:{proj_path}:Z',
-            '--security-opt', 'label=type:container_runtime_t',
+        exec_agent_opts = []
+        if use_exec_agent:
+            exec_agent_dir(name).mkdir(parents=True, exist_ok=True)
+            exec_agent_opts = ['--label', 'probox.exec_agent=1', '--volume', f"{exec_agent_dir(name)}:/run/probox:Z"]
+
+        image_id = image_future.result()
+        agent_future.result()
+        if broker_future is not None:
+            broker_future.result()
+        pinp_root_storage, pinp_user_storage = storage_future.result()
+        executor.shutdown()
+
+        create_args = [
+            'create', *basic_create_options, '--label', f'probox.project_path={proj_path}',
+            '--label', f'probox.from_image={from_image}',
+            *(['--label', f'probox.pool={from_image}'] if pool else []),
+            '--userns=keep-id',
+            '--pids-limit=-1',
+            '--cap-add=NET_RAW',  # For pings as non-root
+            '--device=/dev/fuse',  # For rootless PINP, see https://www.redhat.com/en/blog/podman-inside-container
+            '--device=/dev/net/tun',  # To enable using `pasta`
+            *proj_dir_mount_opts,
+            *(['--privileged'] if privileged else []),
+            '--volume', f"{ssh_agent_socket(name)}:{Path.home() / 'ssh-agent.sock'}:Z",  # also with :Z flag
+            *(['--label', 'probox.tokens=1', '--volume', f"{token_broker_socket(name)}:{Path.home() / 'tokens.sock'}:Z"] if broker_future else []),
+            # TODO: should put containers cache in ~/.cache ?
+            '--volume', f"{pinp_root_storage}:/var/lib/containers:Z",
+            '--volume', f"{pinp_user_storage}:{Path.home() / '.local/share/containers'}:Z",
+            *pinp_opts,
+            *shared_cache_mount_opts(),
+            *exec_agent_opts,
+            *overlay_mount_opts,
+
+            # pasta: auto forward ports from container to host, but not other way around
+            # WARNING: binding on 0.0.0.0 in a container will ALSO expose it on 0.0.0.0 on the host!
+            # I use a firewall to fix this, so I can also temporarily allow it (e.g. to allow my phone on WiFi to view a webapp)
+            '--network=pasta:-t,auto,-u,auto,-T,none,-U,none',
+            image_id
         ]
-    else:
-        # fallback to not kill a users home directory (docs require us to do it)
-        proj_dir_mount_opts = ['--volume', f'{proj_path}:{proj_path}']
-        if not privileged:
-            status("WARNING: home dir is selected as main directory, disabling SELinux!")
-            proj_dir_mount_opts.extend(['--security-opt', 'label=disable'])
-
-    pinp_storage_id = name + '-' + ''.join(random.choice('0123456789ABCDEF') for i in range(6))
-
-    run_podman(
-        'create', *basic_create_options, '--label', f'probox.project_path={proj_path}',
-        '--userns=keep-id',
-        '--pids-limit=-1',
-        '--cap-add=NET_RAW',  # For pings as non-root
-        '--device=/dev/fuse',  # For rootless PINP, see https://www.redhat.com/en/blog/podman-inside-container
-        '--device=/dev/net/tun',  # To enable using `pasta`
-        *proj_dir_mount_opts,
-        *(['--privileged'] if privileged else []),
-        '--volume', f"{ssh_agent_socket(name)}:{Path.home() / 'ssh-agent.sock'}:Z",  # also with :Z flag
-        # for faster builds in PINP: allow FUSE overlayfs?
-        # TODO: should put containers cache in ~/.cache ?
-        '--volume', f"{make_pinp_container_storage(pinp_storage_id)}:/var/lib/containers:Z",
-        '--volume', f"{make_pinp_container_storage(pinp_storage_id + '-' + getpass.getuser())}:{Path.home() / '.local/share/containers'}:Z",
-
-        # pasta: auto forward ports from container to host, but not other way around
-        # WARNING: binding on 0.0.0.0 in a container will ALSO expose it on 0.0.0.0 on the host!
-        # I use a firewall to fix this, so I can also temporarily allow it (e.g. to allow my phone on WiFi to view a webapp)
-        '--network=pasta:-t,auto,-u,auto,-T,none,-U,none',
-        image_id
-    )
+        timed(timings, 'create', run_podman, *create_args)
 
-    if push_overlay:
-        run_podman('start', name, quiet=True)
-        push_overlay_to_container(name)
+    # Otherwise podman creates the missing mount points in the home directory (and their parents) on the
+    # first start, owned by root. For file mounts, only the parents.
+    volumes = [volume.split(':')[:2] for opt, volume in zip(create_args, create_args[1:]) if opt == '--volume']
+    home_dirs = sorted({
+        str((Path(target) if Path(source).is_dir() else Path(target).parent).relative_to(Path.home()))
+        for source, target in volumes if Path.home() in Path(target).parents
+    } - {'.'})
+    if home_dirs:
+        subprocess.run([*container_home_command(name, False), 'mkdir', '-p', '--', *home_dirs], check=True)
+        invalidate_size(name)
+
+    if push_overlay and 'home_overlay' in config:
+        # A leftover manifest from an earlier box with the same name would hide files
+        overlay_manifest_file(name).unlink(missing_ok=True)
+        timed(timings, 'overlay', sync_overlay, name, 'push')
+
+    status(f"Created {name} in {time.monotonic() - started:.2f}s:", ', '.join(f"{stage} {t:.2f}s" for stage, t in timings.items()))
 
 
 def find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name):
@@ -280,16 +989,374 @@ def find_container_name_by_path_or_name(containers_by_path, containers_by_name,
     return path_or_name
 
 
-def run(*, path_or_name, cmd=None):
+def select_containers(path_or_name, all_boxes=False, labels=[]):
+    # Returns the selected container names, and whether this was a bulk selection (--all, --label or a glob)
+    containers_by_path, containers_by_name = get_containers()
+    is_glob = path_or_name is not None and any(c in path_or_name for c in '*?[')
+    if not (all_boxes or labels or is_glob):
+        return [find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name)], False
+
+    names = sorted(containers_by_name)
+    if not any(label.partition('=')[0] == 'probox.pool' for label in labels):
+        # Pool boxes are managed by `probox pool`, bulk commands only touch them when asked for explicitly
+        names = [n for n in names if 'probox.pool' not in containers_by_name[n]['Labels']]
+    if is_glob:
+        names = fnmatch.filter(names, path_or_name)
+    for label in labels:
+        key, has_value, value = label.partition('=')
+        names = [n for n in names if key in containers_by_name[n]['Labels'] and (not has_value or containers_by_name[n]['Labels'][key] == value)]
+    if not names:
+        status("No matching containers")
+        sys.exit(1)
+    return names, True
+
+
+def for_each_container(names, func, jobs=8):
+    # Runs func on every container concurrently, then reports per container and fails if any did
+    def attempt(name):
+        start = time.monotonic()
+        try:
+            func(name)
+            result = 'ok'
+        except SystemExit:
+            result = 'failed'
+        except Exception as e:
+            result = f'failed: {e}'
+        return result, time.monotonic() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = dict(zip(names, pool.map(attempt, names)))
+    print_table(['NAME', 'RESULT', 'TIME'], [[name, result, f'{t:.1f}s'] for name, (result, t) in results.items()])
+    if any(result != 'ok' for result, t in results.values()):
+        sys.exit(1)
+
+
+def add_selector_arguments(parser, jobs=8):
+    parser.add_argument('--all', action="store_true", dest='all_boxes', help="Select all containers")
+    parser.add_argument('--label', action="append", default=[], help="Select containers with this label (key or key=value, repeatable)")
+    parser.add_argument('--jobs', type=int, default=jobs, help=f"Number of containers to handle at the same time (default = {jobs})")
+
+
+def start_container(name):
+    start_ssh_agent(name)
+    container = get_containers()[1][name]
+    if 'probox.tokens' in container['Labels']:
+        start_token_broker(name)
+    if 'probox.exec_agent' in container['Labels']:
+        # /run/user is emptied on reboot, but podman needs the directory to mount it
+        exec_agent_dir(name).mkdir(parents=True, exist_ok=True)
+    started = time.monotonic()
+    if container['State'] == 'paused':
+        # Paused by `probox idle`
+        run_podman('unpause', name, quiet=True)
+        return
+
+    restored = False
+    if capture_podman('container', 'inspect', name)[0]['State'].get('Checkpointed'):
+        restored = run_podman('container', 'restore', name, check=False, quiet=True).returncode == 0
+        if restored:
+            status(f"Restored {name} from checkpoint in {time.monotonic() - started:.2f}s")
+        else:
+            status("Restoring from checkpoint failed, starting normally")
+    if not restored:
+        run_podman('start', name, quiet=True)
+        status(f"Started {name} in {time.monotonic() - started:.2f}s")
+    if 'probox.exec_agent' in container['Labels']:
+        start_exec_agent(name)
+
+
+def start(path_or_name, all_boxes=False, labels=[], jobs=8):
+    names, bulk = select_containers(path_or_name, all_boxes, labels)
+    if bulk:
+        for_each_container(names, start_container, jobs)
+    else:
+        start_container(names[0])
+
+
+# Runs inside the box (as the user) and spawns commands for `probox run`, see exec_agent_run for the protocol
+exec_agent_code = r"""
+import os, sys, json, pty, fcntl, termios, select, signal, socket, struct, subprocess
+
+
+def send(conn, kind, data=b''):
+    conn.sendall(kind + struct.pack('!I', len(data)) + data)
+
+
+def pop_frames(buffer):
+    frames = []
+    while len(buffer) >= 5:
+        size = struct.unpack('!I', buffer[1:5])[0]
+        if len(buffer) < 5 + size:
+            break
+        frames.append((bytes(buffer[:1]), bytes(buffer[5:5 + size])))
+        del buffer[:5 + size]
+    return frames
+
+
+def serve(conn):
+    buffer = bytearray()
+    frames = []
+    while not frames:
+        chunk = conn.recv(65536)
+        if not chunk:
+            return
+        buffer += chunk
+        frames = pop_frames(buffer)
+    request = json.loads(frames.pop(0)[1])
+    options = dict(cwd=request['cwd'], env={**os.environ, **request['env']})
+    try:
+        if request['tty']:
+            master, slave = pty.openpty()
+            fcntl.ioctl(master, termios.TIOCSWINSZ, struct.pack('HHHH', *request['size'], 0, 0))
+            proc = subprocess.Popen(
+                request['argv'], stdin=slave, stdout=slave, stderr=slave, start_new_session=True,
+                preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0), **options
+            )
+            os.close(slave)
+            outputs, stdin = {master: b'o'}, master
+        else:
+            proc = subprocess.Popen(request['argv'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **options)
+            outputs, stdin = {proc.stdout.fileno(): b'o', proc.stderr.fileno(): b'r'}, proc.stdin.fileno()
+    except OSError as e:
+        send(conn, b'r', f'probox exec agent: {e}\n'.encode())
+        send(conn, b'x', struct.pack('!i', 127))
+        return
+
+    # Input is written as the command takes it, and we only read more once it took all, so its output keeps
+    # flowing in the meantime (a blocking write could wait for a command that waits for us to read)
+    os.set_blocking(stdin, False)
+    pending, closing = bytearray(), False
+    while outputs:
+        for kind, data in frames:
+            if kind == b'i' and stdin is not None:
+                pending += data
+            elif kind == b'e' and not request['tty']:
+                closing = True
+            elif kind == b'w':
+                fcntl.ioctl(master, termios.TIOCSWINSZ, data + bytes(4))
+        frames = []
+        if closing and not pending and stdin is not None:
+            os.close(stdin)
+            stdin = None
+        readable, writable, _ = select.select([*outputs, *([] if pending else [conn])], [stdin] if pending else [], [])
+        if writable:
+            try:
+                del pending[:os.write(stdin, pending)]
+            except BlockingIOError:
+                pass
+            except OSError:  # the command doesn't read anymore
+                pending.clear()
+        for fd in readable:
+            if fd is conn:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    # Client is gone, like a closed terminal
+                    os.killpg(proc.pid, signal.SIGHUP) if request['tty'] else proc.terminate()
+                    return
+                buffer += chunk
+                frames = pop_frames(buffer)
+                continue
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            except OSError:  # EIO from the pty once the command exited
+                data = b''
+            if data:
+                send(conn, outputs[fd], data)
+            else:
+                del outputs[fd]
+
+    returncode = proc.wait()
+    send(conn, b'x', struct.pack('!i', returncode if returncode >= 0 else 128 - returncode))
+
+
+def main(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        if probe.connect_ex(path) == 0:
+            return  # already running
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(16)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        conn, _ = server.accept()
+        if os.fork() == 0:
+            server.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                serve(conn)
+            finally:
+                os._exit(0)
+        conn.close()
+
+
+main(sys.argv[1])
+"""
+
+
+def exec_agent_dir(name):
+    return Path(f'/run/user/{os.getuid()}/probox-{name}')
+
+
+def exec_agent_socket(name):
+    return exec_agent_dir(name) / 'exec.sock'
+
+
+def exec_agent_state_file(name, kind):
+    # Kept on the host side (exec_agent_dir is writable from inside the box): the exec ID of the agent's
+    # `podman exec -d` session ('id'), and a lock every `probox run` through the agent holds ('sessions')
+    path = probox_runtime_dir() / 'exec-agents' / f'{name}.{kind}'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def exec_agent_busy(name):
+    # Whether a `probox run` is using the agent, i.e. whether its lock is held
+    try:
+        with open(exec_agent_state_file(name, 'sessions')) as sessions:
+            fcntl.flock(sessions, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+    except FileNotFoundError:
+        return False
+    except BlockingIOError:
+        return True
+
+
+def start_exec_agent(name, wait=True):
+    if socket_alive(exec_agent_socket(name)):
+        return
+    res = subprocess.run(
+        [podman_binary, 'exec', '-d', '--user', getpass.getuser(), name, 'python3', '-c', exec_agent_code, '/run/probox/exec.sock'],
+        stdout=subprocess.PIPE, text=True, check=False
+    )
+    if res.returncode == 0:
+        # The agent's session is always there, `probox idle` looks at exec_agent_busy instead
+        exec_agent_state_file(name, 'id').write_text(res.stdout.strip())
+    if wait:
+        for i in range(40):
+            if socket_alive(exec_agent_socket(name)):
+                return
+            time.sleep(0.05)
+        status("Exec agent didn't start (is python3 in the image?), using podman exec")
+
+
+def frame(kind, data=b''):
+    return kind + struct.pack('!I', len(data)) + data
+
+
+def send_frame(conn, kind, data=b''):
+    conn.sendall(frame(kind, data))
+
+
+def pop_frames(buffer):
+    frames = []
+    while len(buffer) >= 5:
+        size = struct.unpack('!I', buffer[1:5])[0]
+        if len(buffer) < 5 + size:
+            break
+        frames.append((bytes(buffer[:1]), bytes(buffer[5:5 + size])))
+        del buffer[:5 + size]
+    return frames
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def exec_agent_run(name, cmd, env, workdir, use_pty=None):
+    # Frames are a type byte, a 4-byte length and the payload. We send a JSON request (h), then input (i),
+    # end of input (e) and window sizes (w). The agent sends output (o), stderr (r) and the exit code (x).
+    # Returns the exit code, or None if the agent can't be reached.
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(str(exec_agent_socket(name)))
+    except OSError:
+        conn.close()
+        return None
+    # Held until we're done, so `probox idle` knows the box is in use
+    sessions = open(exec_agent_state_file(name, 'sessions'), 'w')
+    fcntl.flock(sessions, fcntl.LOCK_SH)
+
+    if use_pty is None:
+        use_pty = sys.stdin.isatty() and sys.stdout.isatty()
+    size = shutil.get_terminal_size()
+    send_frame(conn, b'h', json.dumps({
+        'argv': cmd, 'cwd': str(workdir), 'tty': use_pty, 'size': [size.lines, size.columns],
+        'env': {**{k: str(v) for k, v in env.items()}, **({'TERM': os.getenv('TERM', 'xterm')} if use_pty else {})},
+    }).encode())
+
+    # SIGWINCH wakes up select through this pipe
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    old_wakeup_fd = signal.set_wakeup_fd(wake_w)
+    old_winch = signal.signal(signal.SIGWINCH, lambda *args: None)
+    old_mode = termios.tcgetattr(0) if use_pty else None
+    if use_pty:
+        tty.setraw(0)
+
+    # Frames to the agent wait in pending until it takes them, so we keep reading output while it doesn't. And
+    # we only read more input once it took what we have.
+    conn.setblocking(False)
+    code = None
+    buffer, pending = bytearray(), bytearray()
+    stdin_open = True
+    try:
+        while code is None:
+            readable, writable, _ = select.select([conn, wake_r, *([0] if stdin_open and not pending else [])], [conn] if pending else [], [])
+            if writable:
+                try:
+                    del pending[:conn.send(pending)]
+                except BlockingIOError:
+                    pass
+            for fd in readable:
+                if fd == wake_r:
+                    os.read(wake_r, 512)
+                    if use_pty:
+                        size = os.get_terminal_size(1)
+                        pending += frame(b'w', struct.pack('HH', size.lines, size.columns))
+                elif fd == 0:
+                    data = os.read(0, 65536)
+                    pending += frame(b'i' if data else b'e', data)
+                    stdin_open = bool(data)
+                else:
+                    try:
+                        chunk = conn.recv(65536)
+                    except BlockingIOError:
+                        continue
+                    if not chunk:
+                        return 255
+                    buffer += chunk
+                    for kind, data in pop_frames(buffer):
+                        if kind == b'x':
+                            code = struct.unpack('!i', data)[0]
+                        else:
+                            write_all(1 if kind == b'o' else 2, data)
+    finally:
+        if use_pty:
+            termios.tcsetattr(0, termios.TCSADRAIN, old_mode)
+        signal.signal(signal.SIGWINCH, old_winch)
+        signal.set_wakeup_fd(old_wakeup_fd)
+        os.close(wake_r)
+        os.close(wake_w)
+        conn.close()
+        sessions.close()
+    return code
+
+
+def run(*, path_or_name, cmd=None, project_path=None):
     containers_by_path, containers_by_name = get_containers()
     container_name = find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name)
 
-    container_data = capture_podman('container', 'inspect', container_name)[0]
-    project_path = Path(container_data['Config']['Labels']['probox.project_path'])
+    container = containers_by_name[container_name]
+    project_path = project_path or Path(container['Labels']['probox.project_path'])
 
-    if not container_data['State']['Running']:
-        start_ssh_agent(container_name)
-        run_podman('start', container_name, quiet=True)
+    if not is_running(container):
+        start_container(container_name)
 
     cwd = Path(os.getcwd()).absolute()
     if project_path == cwd or project_path in cwd.parents:
@@ -298,7 +1365,7 @@ def run(*, path_or_name, cmd=None):
         workdir = Path.home()
 
     if not cmd:
-        cmd = container_data['Config']['Labels'].get('probox.start_shell', '/bin/bash').split(' ')
+        cmd = container['Labels'].get('probox.start_shell', '/bin/bash').split(' ')
 
     env = {
         'SSH_AUTH_SOCK': str(Path.home() / 'ssh-agent.sock'),
@@ -308,6 +1375,12 @@ def run(*, path_or_name, cmd=None):
         'PROJECT_PATH': project_path
     }
 
+    if 'probox.exec_agent' in container['Labels']:
+        if exec_agent_run(container_name, cmd, env, workdir) is not None:
+            return
+        # Probably killed from within the box, it will be back for the next run
+        start_exec_agent(container_name, wait=False)
+
     with tempfile.NamedTemporaryFile(mode='w+') as f:
         for k, v in env.items():
             f.write(f"{k}={v}\n")
@@ -315,7 +1388,292 @@ def run(*, path_or_name, cmd=None):
         run_podman('exec', '-it', '--user', getpass.getuser(), '--workdir', str(workdir), '--env-file', f.name, container_name, *cmd, check=False)
 
 
+# Changes in these directories come from the package manager (or are throwaway), the new base image has its own
+upgrade_ignore = ['/usr', '/var/lib/pacman', '/var/cache', '/var/log', '/var/tmp', '/tmp', '/run', '/etc/pacman.d/gnupg', '/etc/ld.so.cache']
+
+
+def explicit_packages(name):
+    # What `pacman -Qqe` says, read from the package database of a stopped container (empty without pacman)
+    res = subprocess.run([*container_home_command(name, False, '/'), 'sh', '-c', 'cat var/lib/pacman/local/*/desc'], capture_output=True, text=True)
+    entries = res.stdout.split('%NAME%\n')[1:] if res.returncode == 0 else []
+    return {entry.split('\n', 1)[0] for entry in entries if '%REASON%\n1\n' not in entry}
+
+
+def upgrade(path_or_name, from_image=None, keep_old=False):
+    containers_by_path, containers_by_name = get_containers()
+    name = find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name)
+    container_data = capture_podman('container', 'inspect', name)[0]
+    labels = container_data['Config']['Labels']
+    from_image = from_image or labels.get('probox.from_image') or config['default_image']
+    mounts = {m['Destination']: m['Source'] for m in container_data['Mounts']}
+    pinp_storage_id = Path(mounts['/var/lib/containers']).name
+
+    # The box's own changes, as relative paths so tar can replay them on the new root
+    ignore = tuple(config.get('upgrade_ignore', upgrade_ignore))
+    diff = capture_podman('diff', name)
+    ignored_by = lambda p: next((prefix for prefix in ignore if p == prefix or p.startswith(prefix + '/')), None)
+    changes = sorted(p.lstrip('/') for p in (diff.get('changed') or []) + (diff.get('added') or []) if ignored_by(p) is None)
+    deletions = sorted(p.lstrip('/') for p in (diff.get('deleted') or []) if ignored_by(p) is None)
+    status(f"Keeping {len(changes)} changed and {len(deletions)} deleted paths of {name}")
+    dropped = sorted(p for p in (diff.get('changed') or []) + (diff.get('added') or []) + (diff.get('deleted') or []) if ignored_by(p) is not None)
+    if dropped:
+        dropped_file = probox_data_dir() / f'{name}-upgrade-dropped.txt'
+        dropped_file.write_text(''.join(p + '\n' for p in dropped))
+        counts = {}
+        for p in dropped:
+            prefix = ignored_by(p)
+            counts[prefix] = counts.get(prefix, 0) + 1
+        status(f"Dropping {len(dropped)} paths the new image brings itself ({', '.join(f'{prefix}: {n}' for prefix, n in counts.items())}), listed in {dropped_file}")
+
+    if containers_by_name[name]['State'] in ('running', 'paused'):
+        stop_container(name)
+    archive = probox_data_dir() / f'{name}-upgrade.tar'
+    # Through stdin and stdout, the host isn't visible from the chroot
+    with archive.open('wb') as f:
+        subprocess.run(
+            [*container_home_command(name, False, '/'), 'tar', '-c', '--no-recursion', '--numeric-owner', '--null', '-T', '-', '-f', '-'],
+            input='\0'.join(changes).encode(), stdout=f, check=True
+        )
+    old_packages = explicit_packages(name)
+
+    old_name = f'{name}-preupgrade'
+    run_podman('rename', name, old_name)
+    created = False
+    try:
+        run_podman('pull', from_image)
+        create(
+            path=labels['probox.project_path'], name=name, from_image=from_image, privileged=container_data['HostConfig']['Privileged'],
+            push_overlay=False, ignore_existing_containers=True, pinp_storage_id=pinp_storage_id,
+            pinp_driver=labels.get('probox.pinp_driver'), features_from=container_data
+        )
+        created = True
+        missing = sorted(old_packages - explicit_packages(name))
+        if missing:
+            # Installed with pacman in the box, so dropped along with /usr
+            status(f"Not in the new image, reinstall if still needed: pacman -S --needed {' '.join(missing)}")
+        with archive.open('rb') as f:
+            subprocess.run([*container_home_command(name, False, '/'), 'tar', '-x', '-p', '--same-owner', '--numeric-owner', '-f', '-'], stdin=f, check=True)
+        if deletions:
+            # Chrooted like the tar above, so links the box made (now restored) can't lead rm to host files
+            subprocess.run([*container_home_command(name, False, '/'), 'rm', '-rf', '--', *deletions], check=True)
+        invalidate_size(name)
+    except BaseException:
+        if not created:
+            run_podman('rename', old_name, name, check=False)
+            status(f"Upgrade failed, {name} is left as it was")
+        else:
+            status(f"Upgrade failed, the old container is kept as {old_name} (changes in {archive})")
+        raise
+
+    archive.unlink()
+    if keep_old:
+        status(f"Upgraded {name}, the old container is kept as {old_name} (it has the same PINP storage, don't run both at once)")
+    else:
+        run_podman('rm', old_name, quiet=True)
+        status(f"Upgraded {name}")
+
+
+manifest_keys = {'path', 'name', 'image', 'privileged', 'overlay'}
+
+
+def apply(manifest_file, yes=False, jobs=4):
+    # Creates the boxes of a manifest ([[box]] tables) that don't exist yet, existing ones are left alone
+    manifest_file = Path(manifest_file)
+    with manifest_file.open('rb') as f:
+        boxes = tomllib.load(f).get('box', [])
+    containers_by_path, containers_by_name = get_containers()
+    taken = set(containers_by_name)
+
+    plan = []
+    to_create = {}
+    planned_paths = set()
+    for box in boxes:
+        if 'path' not in box or box.keys() - manifest_keys:
+            status(f"Each [[box]] needs a path and can only have {', '.join(sorted(manifest_keys))}, got:", box)
+            sys.exit(1)
+        # Relative paths are relative to the manifest
+        proj_path = (manifest_file.parent / Path(box['path']).expanduser()).absolute()
+        image = box.get('image', config['default_image'])
+        if proj_path in planned_paths:
+            plan.append(['conflict (path listed twice)', box.get('name', '-'), proj_path, image])
+            continue
+        planned_paths.add(proj_path)
+        existing = containers_by_path.get(proj_path)
+        if existing is not None:
+            name = existing['Names'][0]
+            differences = []
+            if box.get('name', name) != name:
+                differences.append(f"named {name}")
+            if existing['Labels'].get('probox.from_image', image) != image:
+                differences.append(f"from {existing['Labels']['probox.from_image']}")
+            plan.append(['differs (' + ', '.join(differences) + ')' if differences else 'exists', name, proj_path, image])
+            continue
+
+        name = box.get('name') or suggest_name(proj_path, taken)
+        if name in taken:
+            plan.append(['conflict (name in use)', name, proj_path, image])
+            continue
+        taken.add(name)
+        to_create[name] = dict(
+            path=proj_path, name=name, from_image=image, privileged=box.get('privileged', False), push_overlay=box.get('overlay', True)
+        )
+        plan.append(['create', name, proj_path, image])
+
+    print_table(['ACTION', 'NAME', 'PATH', 'IMAGE'], plan)
+    if any(action.startswith('conflict') for action, *rest in plan):
+        status("Resolve the conflicts in the manifest, every box needs its own name and path")
+        sys.exit(1)
+    if any(action.startswith('differs') for action, *rest in plan):
+        status("Existing containers are left as they are (see `probox upgrade --from`)")
+    if not to_create:
+        status("Nothing to create")
+        return
+    if not yes and input(f"Create {len(to_create)} containers? [y/N] ").strip().lower() != 'y':
+        return
+
+    # Names and paths are reserved and derived images built under locks, so these can run side by side
+    for_each_container(list(to_create), lambda name: create(**to_create[name]), jobs)
+
+
+def spawn_detached(*args):
+    # Runs probox itself in the background, surviving the current process
+    subprocess.Popen(
+        [sys.executable, str(Path(__file__).absolute()), *args], start_new_session=True,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def pool_dir():
+    return probox_runtime_dir() / 'pool'
+
+
+def pool_images():
+    return config.get('temp_pool', {}).get('images', [config['default_image']])
+
+
+def pool_mounts():
+    # Mount points in podman's (rootless) mount namespace, where the staging directories are mounted. After a
+    # reboot (or when the namespace was torn down) they're gone, and so are the staging directories.
+    res = subprocess.run([podman_binary, 'unshare', 'cat', '/proc/self/mountinfo'], capture_output=True, text=True)
+    # Spaces and such are octal escaped
+    unescape = lambda path: re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+    return {unescape(line.split()[4]) for line in res.stdout.splitlines()}
+
+
+def claim_marker(name):
+    # Claiming is creating this directory, which only one process can do
+    marker = pool_dir() / f'{name}.claimed'
+    try:
+        marker.mkdir(parents=True)
+        return True
+    except FileExistsError:
+        return False
+
+
+def fill_pool():
+    # Pool boxes are created, started and have their overlay pushed. Their project directory is an empty
+    # staging directory that is a shared mount in podman's (rootless) mount namespace, so a claim can
+    # bind the real project onto it later on.
+    pool_dir().mkdir(parents=True, exist_ok=True)
+    with open(pool_dir() / 'fill.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            status("Pool is already being filled")
+            return
+
+        size = config.get('temp_pool', {}).get('size', 2)
+        containers = [c for c in list_containers() if 'probox.pool' in c['Labels'] and not (pool_dir() / f"{c['Names'][0]}.claimed").exists()]
+        mounts = pool_mounts() if containers else set()
+        usable = [c for c in containers if is_running(c) and c['Labels']['probox.project_path'] in mounts]
+        for c in containers:
+            if c not in usable and claim_marker(c['Names'][0]):
+                # Stopped or lost its staging mount, so a claim couldn't bind a project into it
+                status(f"Removing dead pool box {c['Names'][0]}")
+                release_pool_box(c['Names'][0])
+        for from_image in pool_images():
+            available = [c for c in usable if c['Labels']['probox.pool'] == from_image]
+            for i in range(size - len(available)):
+                name = 'pbt-' + ''.join(random.choice('0123456789ABCDEF') for i in range(6))
+                staging = pool_dir() / name
+                staging.mkdir()
+                subprocess.run([podman_binary, 'unshare', 'sh', '-c', 'mount --bind "$1" "$1" && mount --make-shared "$1"', 'sh', str(staging)], check=True)
+                create(path=staging, name=name, from_image=from_image, ignore_existing_containers=True, pool=True)
+                run_podman('start', name, quiet=True)
+
+
+def claim_pool_box(from_image, proj_path):
+    for c in list_containers():
+        name = c['Names'][0]
+        if c['Labels'].get('probox.pool') != from_image or not is_running(c) or not Path(c['Labels']['probox.project_path']).is_dir():
+            continue
+        if not claim_marker(name):
+            continue
+
+        status(f"Using {name} from the pool")
+        staging = c['Labels']['probox.project_path']
+        container_data = capture_podman('container', 'inspect', name)[0]
+        if Path('/sys/fs/selinux/enforce').exists():
+            # What :Z would have done
+            subprocess.run(['chcon', '-R', container_data['MountLabel'], str(proj_path)], check=True)
+        # Bind the project onto the staging directory (which propagates into the container), and then
+        # inside the container onto the project path itself
+        subprocess.run([podman_binary, 'unshare', 'mount', '--bind', str(proj_path), staging], check=True)
+        subprocess.run([
+            podman_binary, 'unshare', 'nsenter', '-t', str(container_data['State']['Pid']), '-U', '-m',
+            'sh', '-c', 'mkdir -p "$2" && mount --bind "$1" "$2"', 'sh', staging, str(proj_path)
+        ], check=True)
+        start_ssh_agent(name)
+        return name
+    return None
+
+
+def release_pool_box(name):
+    # Also cleans up after boxes that are half gone, e.g. after a reboot emptied the runtime directory
+    stop_ssh_agent(name)
+    stop_token_broker(name)
+    run_podman('rm', '--force', '--time', '0', name, check=False, quiet=True)
+    staging = pool_dir() / name
+    if staging.exists():
+        subprocess.run([podman_binary, 'unshare', 'umount', '-R', str(staging)], check=False, stderr=subprocess.DEVNULL)
+        staging.rmdir()
+    try:
+        (pool_dir() / f'{name}.claimed').rmdir()
+    except FileNotFoundError:
+        pass
+
+
+def pool(operation, name=None):
+    if operation == 'fill':
+        fill_pool()
+    elif operation == 'release':
+        release_pool_box(name)
+    elif operation == 'clear':
+        for c in list_containers():
+            if 'probox.pool' in c['Labels'] and claim_marker(c['Names'][0]):
+                release_pool_box(c['Names'][0])
+    else:
+        rows = []
+        for c in list_containers():
+            if 'probox.pool' in c['Labels']:
+                claimed = (pool_dir() / f"{c['Names'][0]}.claimed").exists()
+                rows.append([c['Names'][0], c['Labels']['probox.pool'], c['State'], 'claimed' if claimed else 'available'])
+        print_table(['NAME', 'IMAGE', 'STATE', 'POOL'], rows)
+
+
 def temp(path=None, from_image=None, privileged=False, push_overlay=True):
+    proj_path = Path(os.getcwd() if path is None else path).absolute()
+    if 'temp_pool' in config and not privileged and push_overlay and proj_path != Path.home():
+        name = claim_pool_box(from_image or config['default_image'], proj_path)
+        spawn_detached('pool', 'fill')
+        if name is not None:
+            try:
+                run(path_or_name=name, project_path=proj_path)
+            finally:
+                spawn_detached('pool', 'release', name)
+            return
+        status("Pool is empty, creating a new container")
+
     random_id = ''.join(random.choice('0123456789ABCDEF') for i in range(6))
     name = f'pbt-{random_id}'
     create(
@@ -329,25 +1687,50 @@ def temp(path=None, from_image=None, privileged=False, push_overlay=True):
         run_podman('rm', name, quiet=True)
 
 
-def stop(path_or_name):
-    containers_by_path, containers_by_name = get_containers()
-    container_name = find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name)
-
-    container_data = capture_podman('container', 'inspect', container_name)[0]
-    if container_data['State']['Running']:
-        run_podman('stop', container_name, quiet=True)
-    stop_ssh_agent(container_name)
+def stop_container(name, checkpoint=False):
+    state = get_containers()[1][name]['State']
+    if state == 'paused':
+        # Paused by `probox idle`. Running again first, as podman can't checkpoint a paused container.
+        run_podman('unpause', name, quiet=True)
+    if state in ('running', 'paused'):
+        # A checkpoint (CRIU) keeps the processes' memory, so `run` can resume where it left off
+        if not checkpoint or run_podman('container', 'checkpoint', name, check=False, quiet=True).returncode != 0:
+            if checkpoint:
+                status("Checkpoint failed, stopping normally")
+            run_podman('stop', name, quiet=True)
+    stop_ssh_agent(name)
+    stop_token_broker(name)
+
+
+def stop(path_or_name, all_boxes=False, labels=[], jobs=8, checkpoint=False):
+    names, bulk = select_containers(path_or_name, all_boxes, labels)
+    if bulk:
+        for_each_container(names, lambda name: stop_container(name, checkpoint), jobs)
+    else:
+        stop_container(names[0], checkpoint)
 
 
-def ssh_add(path_or_name, args):
-    containers_by_path, containers_by_name = get_containers()
-    container_name = find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name)
+def ssh_add(path_or_name, args, all_boxes=False, labels=[]):
+    if (all_boxes or labels) and path_or_name is not None:
+        # There's no room for a path or name then, so it's the first argument for ssh-add
+        path_or_name, args = None, [path_or_name, *args]
+    names, bulk = select_containers(path_or_name, all_boxes, labels)
+    containers_by_name = get_containers()[1]
 
-    container_data = capture_podman('container', 'inspect', container_name)[0]
-    if not container_data['State']['Running']:
-        status("Container is not running, so neither is its ssh-agent.")
+    def add(name):
+        if not is_running(containers_by_name[name]):
+            status("Container is not running, so neither is its ssh-agent.")
+            sys.exit(1)
+        if subprocess.run(['ssh-add', *args], env={**os.environ, "SSH_AUTH_SOCK": ssh_agent_socket(name)}).returncode != 0:
+            raise RuntimeError("ssh-add failed")
+
+    if bulk:
+        # One at a time, ssh-add may ask for a passphrase
+        for_each_container(names, add, jobs=1)
+    elif is_running(containers_by_name[names[0]]):
+        subprocess.run(['ssh-add', *args], env={**os.environ, "SSH_AUTH_SOCK": ssh_agent_socket(names[0])})
     else:
-        subprocess.run(['ssh-add', *args], env={**os.environ, "SSH_AUTH_SOCK": ssh_agent_socket(container_name)})
+        status("Container is not running, so neither is its ssh-agent.")
 
 
 def name(path_or_name):
@@ -355,8 +1738,149 @@ def name(path_or_name):
     print(find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name))
 
 
-def ls():
-    run_podman('ps', '--all', '--size', '--filter', 'label=probox.project_path', '--format', 'table {{.ID}} {{.Size}} {{.Status}} {{.Names}} {{.Mounts}}')
+def format_size(size):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1000:
+            break
+        size /= 1000
+    else:
+        unit = 'TB'
+    return f"{size:.1f}{unit}" if unit != 'B' else f"{size}B"
+
+
+def print_table(header, rows, file=None):
+    widths = [max(len(str(v)) for v in column) for column in zip(header, *rows)]
+    for row in [header, *rows]:
+        print('  '.join(str(v).ljust(w) for v, w in zip(row, widths)).rstrip(), file=file)
+
+
+def format_age(seconds):
+    for unit, length in [('d', 86400), ('h', 3600), ('m', 60)]:
+        if seconds >= length:
+            return f"{int(seconds // length)}{unit}"
+    return f"{int(seconds)}s"
+
+
+def sizes_cache_file():
+    return Path(os.getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / 'probox' / 'sizes.json'
+
+
+def load_sizes():
+    try:
+        return json.loads(sizes_cache_file().read_text())
+    except (OSError, ValueError):
+        return {'containers': {}, 'images': {}}
+
+
+def sizes_dirty_dir():
+    return sizes_cache_file().parent / 'dirty'
+
+
+def invalidate_size(name):
+    # For writes to a stopped box (overlay push, upgrade, snapshot restore), which its state doesn't show.
+    # Called after writing: a measurement that started before this has to be redone.
+    sizes_dirty_dir().mkdir(parents=True, exist_ok=True)
+    (sizes_dirty_dir() / name).touch()
+
+
+def refresh_sizes():
+    # Walking writable layers and PINP storage is slow, so a box is only measured again when it may have
+    # changed: while it's running, when it has been started or stopped since the last measurement, or when
+    # probox wrote to it (see invalidate_size)
+    sizes_cache_file().parent.mkdir(parents=True, exist_ok=True)
+    with open(sizes_cache_file().with_suffix('.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # someone else is at it
+
+        cached = load_sizes()['containers']
+        names = [c['Names'][0] for c in list_containers()]
+        sizes, to_measure = {}, {}
+        for data in (capture_podman('container', 'inspect', *names) if names else []):
+            key = [data['State']['Status'], data['State']['StartedAt'], data['State']['FinishedAt']]
+            entry = cached.get(data['Name'], {})
+            try:
+                written = (sizes_dirty_dir() / data['Name']).stat().st_mtime
+            except FileNotFoundError:
+                written = 0
+            if data['State']['Status'] != 'running' and entry.get('key') == key and entry['updated'] > written:
+                sizes[data['Name']] = entry
+                continue
+            mounts = {m['Destination']: m['Source'] for m in data['Mounts']}
+            paths = {
+                'writable': data['GraphDriver']['Data'].get('UpperDir'),
+                'pinp': mounts.get('/var/lib/containers'),
+                'pinp-user': mounts.get(str(Path.home() / '.local/share/containers')),
+            }
+            to_measure[data['Name']] = (key, {part: path for part, path in paths.items() if path})
+
+        all_paths = [path for key, paths in to_measure.values() for path in paths.values()]
+        started = time.time()
+        measured = disk_usage(*all_paths) if all_paths else {}
+        for name, (key, paths) in to_measure.items():
+            sizes[name] = {'key': key, 'updated': started, **{part: measured.get(Path(path), 0) for part, path in paths.items()}}
+
+        for dirty_file in sizes_dirty_dir().glob('*'):
+            if dirty_file.name not in names:
+                dirty_file.unlink()
+
+        images = capture_podman('image', 'ls', '--all', '--filter', 'label=probox.parent_image')
+        data = {'updated': time.time(), 'containers': sizes, 'images': {i['Id']: i['Size'] for i in images}}
+        tmp_file = sizes_cache_file().with_suffix(f'.{os.getpid()}')
+        tmp_file.write_text(json.dumps(data))
+        tmp_file.replace(sizes_cache_file())
+
+
+def cached_sizes(refresh=False):
+    # Returns immediately with what we know, and refreshes in the background when it's getting old
+    if refresh:
+        refresh_sizes()
+    sizes = load_sizes()
+    if time.time() - sizes.get('updated', 0) > config.get('size_cache_ttl', 600):
+        spawn_detached('du', '--refresh')
+        if 'updated' not in sizes:
+            status("Sizes are being computed in the background, try again later (or use --refresh to wait)")
+    return sizes
+
+
+def container_size(sizes, name):
+    entry = sizes['containers'].get(name)
+    if entry is None:
+        return '?', '?'
+    total = entry.get('writable', 0) + entry.get('pinp', 0) + entry.get('pinp-user', 0)
+    return format_size(total), format_age(time.time() - entry['updated'])
+
+
+def du(refresh=False):
+    sizes = cached_sizes(refresh)
+    rows, total = [], 0
+    for c in list_containers():
+        name = c['Names'][0]
+        entry = sizes['containers'].get(name)
+        if entry is None:
+            rows.append([name, '?', '?', '?', '?'])
+            continue
+        box_total = entry.get('writable', 0) + entry.get('pinp', 0) + entry.get('pinp-user', 0)
+        total += box_total
+        rows.append([
+            name, format_size(entry.get('writable', 0)), format_size(entry.get('pinp', 0) + entry.get('pinp-user', 0)),
+            format_size(box_total), format_age(time.time() - entry['updated'])
+        ])
+    images_size = sum(sizes['images'].values())
+    rows.append([f"({len(sizes['images'])} derived images)", '', '', format_size(images_size), ''])
+    rows.append(['total', '', '', format_size(total + images_size), ''])
+    print_table(['NAME', 'WRITABLE', 'PINP', 'TOTAL', 'AGE'], rows)
+
+
+def ls(size=False):
+    sizes = cached_sizes() if size else None
+    rows = []
+    for c in list_containers():
+        name = c['Names'][0]
+        agent = 'running' if ssh_agent_pid(name) is not None else '-'
+        rows.append([c['Id'][:12], *(container_size(sizes, name) if size else []), c['State'], agent, name, ', '.join(c['Mounts'])])
+    print_table(['ID', *(['SIZE', 'AGE'] if size else []), 'STATE', 'SSH-AGENT', 'NAME', 'MOUNTS'], rows)
 
 
 def get_overlay_files():
@@ -366,46 +1890,357 @@ def get_overlay_files():
     return [file.relative_to(home_overlay) for file in home_overlay.rglob('*') if file.is_file()]
 
 
-def push_overlay_to_container(name, files=None):
-    # TODO: container needs to be running ... also it's three commands per file???
-    user = getpass.getuser()
-    group = grp.getgrgid(os.getgid()).gr_name
+def overlay_mount_files():
+    # The overlay files that new containers get as bind mounts, see overlay_mode
+    if config.get('overlay_mode', 'copy') != 'mount':
+        return []
+    # --volume can't take these characters, such files are copied
+    return [f for f in get_overlay_files() if not any(c in str(f) for c in ':,')]
 
-    for relfile in files or get_overlay_files():
-        container_file = Path.home() / relfile
-        subprocess.run(["podman", "exec", "--user", user, name, "mkdir", "-p", str(container_file.parent)], check=True)
-        subprocess.run(["podman", "cp", Path(config['home_overlay']) / relfile, f"{name}:{container_file}"], check=True)
-        subprocess.run(["podman", "exec", name, "chown", f"{user}:{group}", str(container_file)], check=True)
 
+def stale_mounted_files(name, relfiles):
+    # Mounted overlay files that were replaced on the host since the running box started (the mount keeps the old inode)
+    home_overlay = Path(config['home_overlay'])
+    res = subprocess.run([*container_home_command(name, True), 'stat', '--printf', '%i %n\\0', '--', *relfiles], capture_output=True, text=True)
+    inodes = {relfile: int(inode) for inode, relfile in (entry.split(' ', 1) for entry in res.stdout.split('\0') if entry)}
+    return [
+        relfile for relfile in relfiles
+        if not (home_overlay / relfile).is_file() or (home_overlay / relfile).stat().st_ino != inodes.get(relfile)
+    ]
+
+
+def overlay_manifest_file(name):
+    return probox_data_dir() / 'overlay-manifests' / f'{name}.json'
+
+
+def container_home_command(name, running, directory=None):
+    # Prefix for commands that run inside the container's home directory. A stopped container is handled
+    # through its mounted rootfs instead; inside `podman unshare` we are root, which maps to the host user
+    # and therefore (with --userns=keep-id) to the container user as well. The command is chrooted into the
+    # rootfs (and so uses the box's tools), otherwise symlinks in the box would resolve to host paths.
+    directory = str(directory or Path.home())
+    if running:
+        return [podman_binary, 'exec', '-i', '--user', getpass.getuser(), '--workdir', directory, name]
+    script = (
+        'podman=$1; name=$2; root=$("$podman" mount "$name") || exit 1; shift 2; '
+        'chroot "$root" /bin/sh -c \'cd "$1" || exit 1; shift; exec "$@"\' sh "$@"; rc=$?; "$podman" umount "$name" >/dev/null; exit $rc'
+    )
+    return [podman_binary, 'unshare', 'sh', '-c', script, 'sh', podman_binary, name, directory]
+
+
+def host_file_state(path, known=None):
+    st = path.stat()
+    state = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+    if known is not None and (known['size'], known['mtime']) == (state['size'], state['mtime']):
+        return known
+    with path.open('rb') as f:
+        state['sha256'] = hashlib.file_digest(f, 'sha256').hexdigest()
+    return state
+
+
+def container_file_states(name, running, relfiles, manifest):
+    if not relfiles:
+        return {}
+    cmd = container_home_command(name, running)
+    # Missing files make stat fail, we just don't report them
+    res = subprocess.run([*cmd, 'stat', '--printf', '%s %Y %n\\0', '--', *relfiles], capture_output=True, text=True)
+    states = {}
+    for entry in res.stdout.split('\0'):
+        if entry:
+            size, mtime, relfile = entry.split(' ', 2)
+            states[relfile] = {'size': int(size), 'mtime': int(mtime)}
+
+    # Only hash what changed according to size and mtime
+    to_hash = []
+    for relfile, state in states.items():
+        known = manifest.get(relfile)
+        if known is not None and (known['size'], known['mtime']) == (state['size'], state['mtime']):
+            states[relfile] = known
+        else:
+            to_hash.append(relfile)
+    if to_hash:
+        res = subprocess.run([*cmd, 'sha256sum', '-z', '--', *to_hash], capture_output=True, text=True, check=True)
+        for entry in res.stdout.split('\0'):
+            if entry:
+                digest, relfile = entry.split('  ', 1)
+                states[relfile]['sha256'] = digest
+    return states
+
+
+def push_overlay_to_container(name, relfiles, running=True):
+    # One tar stream for all files, extracted as the user so parents and ownership are right
+    home_overlay = Path(config['home_overlay'])
+    extract = subprocess.Popen([*container_home_command(name, running), 'tar', '-x', '--no-same-owner', '-f', '-'], stdin=subprocess.PIPE)
+    with tarfile.open(fileobj=extract.stdin, mode='w|') as tar:
+        for relfile in relfiles:
+            tar.add(home_overlay / relfile, arcname=str(relfile), recursive=False)
+    extract.stdin.close()
+    if extract.wait() != 0:
+        raise subprocess.CalledProcessError(extract.returncode, extract.args)
 
-def pull_overlay_from_container(name, files=None):
-    for relfile in files or get_overlay_files():
-        host_file = Path(config['home_overlay']) / relfile
-        host_file.parent.mkdir(parents=True, exist_ok=True)
-        subprocess.run(["podman", "cp", f"{name}:{Path.home() / relfile}", str(host_file)], check=True)
 
+def pull_overlay_from_container(name, relfiles, running=True):
+    home_overlay = Path(config['home_overlay'])
+    relfiles = {str(relfile) for relfile in relfiles}
+    create = subprocess.Popen([*container_home_command(name, running), 'tar', '-c', '-f', '-', '--', *relfiles], stdout=subprocess.PIPE)
+    with tarfile.open(fileobj=create.stdout, mode='r|') as tar:
+        for member in tar:
+            # Only accept the regular files we asked for, never links or paths outside the overlay
+            if not member.isfile() or member.name not in relfiles:
+                continue
+            host_file = home_overlay / member.name
+            host_file.parent.mkdir(parents=True, exist_ok=True)
+            with tar.extractfile(member) as src, host_file.open('wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.chmod(host_file, member.mode)
+            os.utime(host_file, (member.mtime, member.mtime))
+    if create.wait() != 0:
+        raise subprocess.CalledProcessError(create.returncode, create.args)
+
+
+def sync_overlay(name, operation, files=None, force=False):
+    # The manifest holds the state of each file at the last sync, which is the same on both sides
+    # (tar keeps the mtime). A side whose state differs from it has changed since.
+    home_overlay = Path(config['home_overlay'])
+    manifest_file = overlay_manifest_file(name)
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+    container = get_containers()[1][name]
+    running = is_running(container)
+
+    relfiles = sorted({str(f) for f in files} if files else {str(f) for f in get_overlay_files()} | set(manifest))
+    mounted = [relfile for relfile in relfiles if str(Path.home() / relfile) in container['Mounts']]
+    if mounted:
+        status(f"{len(mounted)} files are mounted from {home_overlay}, nothing to {operation} for those")
+        stale = stale_mounted_files(name, mounted) if running else []
+        if stale:
+            status(f"Replaced on the host since {name} started, restart it to see the new versions:", ' '.join(stale))
+        relfiles = [relfile for relfile in relfiles if relfile not in mounted]
+    host_states = {}
+    for relfile in relfiles:
+        if (home_overlay / relfile).is_file():
+            host_states[relfile] = host_file_state(home_overlay / relfile, manifest.get(relfile))
+    container_states = container_file_states(name, running, relfiles, manifest)
+
+    src_states, dst_states = (host_states, container_states) if operation == 'push' else (container_states, host_states)
+    transfer, skipped = [], []
+    for relfile in relfiles:
+        src, dst, known = src_states.get(relfile), dst_states.get(relfile), manifest.get(relfile)
+        if src is None:
+            continue
+        if dst is not None and dst['sha256'] == src['sha256']:
+            manifest[relfile] = src
+            continue
+        if known is not None and dst is not None and dst['sha256'] != known['sha256'] and not force:
+            skipped.append(relfile)
+            kind = 'Conflict' if src['sha256'] != known['sha256'] else 'Only changed on the other side'
+            status(f"{kind}: {relfile} (use --force to overwrite)")
+            continue
+        transfer.append(relfile)
+
+    if transfer:
+        (push_overlay_to_container if operation == 'push' else pull_overlay_from_container)(name, transfer, running)
+        if operation == 'push' and not running:
+            invalidate_size(name)
+        for relfile in transfer:
+            manifest[relfile] = src_states[relfile]
+
+    manifest_file.parent.mkdir(parents=True, exist_ok=True)
+    manifest_file.write_text(json.dumps(manifest))
+    status(f"Overlay {operation}: {len(transfer)} transferred, {len(skipped)} skipped, {len(relfiles) - len(transfer) - len(skipped)} unchanged")
+    if skipped:
+        sys.exit(1)
 
-def overlay(path_or_name, operation, files=[]):
+
+def overlay(path_or_name, operation, files=[], force=False, all_boxes=False, labels=[], jobs=8):
     if 'home_overlay' not in config:
         status(f"No 'home_overlay' set in config, can't do anything")
         sys.exit(1)
 
-    containers_by_path, containers_by_name = get_containers()
-    container_name = find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name)
+    if (all_boxes or labels) and path_or_name is not None and not any(c in path_or_name for c in '*?['):
+        path_or_name, files = None, [path_or_name, *files]
+    names, bulk = select_containers(path_or_name, all_boxes, labels)
     files = [Path(f) for f in files]
-    if operation == 'push':
-        push_overlay_to_container(container_name, files)
+    if bulk:
+        # Pulls all write to home_overlay, one at a time so each sees what the previous one did (and reports a
+        # file that several boxes changed as a conflict instead of keeping the last one)
+        for_each_container(names, lambda name: sync_overlay(name, operation, files, force=force), jobs if operation == 'push' else 1)
     else:
-        pull_overlay_from_container(container_name, files)
+        sync_overlay(names[0], operation, files, force=force)
+
+
+def snapshots_dir(name):
+    return Path(config.get('snapshot_dir', probox_data_dir() / 'snapshots')).expanduser() / name
+
+
+def snapshot_sources(name, include_project=True):
+    # Everything that makes up a box: its writable layer, its PINP storage and (optionally) the project
+    container_data = capture_podman('container', 'inspect', name)[0]
+    mounts = {m['Destination']: m['Source'] for m in container_data['Mounts']}
+    sources = {
+        'upper': container_data['GraphDriver']['Data'].get('UpperDir'),
+        'pinp-root': mounts.get('/var/lib/containers'),
+        'pinp-user': mounts.get(str(Path.home() / '.local/share/containers')),
+    }
+    if include_project:
+        sources['project'] = container_data['Config']['Labels']['probox.project_path']
+    return {part: Path(source) for part, source in sources.items() if source is not None}
+
+
+def clone_tree(src, dst):
+    # Constant-time where the filesystem allows it. Runs in `podman unshare` since the writable layer and
+    # PINP storage contain files owned by subuids.
+    fs_type = subprocess.run(['stat', '-f', '-c', '%T', str(src)], capture_output=True, text=True).stdout.strip()
+    if fs_type == 'btrfs' and src.stat().st_ino == 256:  # root of a subvolume
+        if subprocess.run([podman_binary, 'unshare', 'btrfs', '-q', 'subvolume', 'snapshot', str(src), str(dst)], stderr=subprocess.DEVNULL).returncode == 0:
+            return 'btrfs'
+    if subprocess.run([podman_binary, 'unshare', 'cp', '-a', '--reflink=always', str(src), str(dst)], stderr=subprocess.DEVNULL).returncode == 0:
+        return 'reflink'
+    subprocess.run([podman_binary, 'unshare', 'rm', '-rf', str(dst)], check=True)
+    subprocess.run([podman_binary, 'unshare', 'cp', '-a', str(src), str(dst)], check=True)
+    return 'copy'
+
+
+def remove_tree(path):
+    if subprocess.run([podman_binary, 'unshare', 'btrfs', '-q', 'subvolume', 'delete', str(path)], capture_output=True).returncode != 0:
+        subprocess.run([podman_binary, 'unshare', 'rm', '-rf', str(path)], check=True)
+
+
+def project_snapshot_conflict(name, project):
+    # Returns the data directory inside the project (e.g. for a box of the home directory), if any. A snapshot
+    # of such a project would copy itself, and a restore would delete the snapshots and the boxes.
+    project = Path(project).resolve()
+    for data_dir in [snapshots_dir(name).parent, probox_data_dir(), probox_config_dir(), podman_storage_dir()]:
+        data_dir = data_dir.resolve()
+        if data_dir == project or project in data_dir.parents:
+            return data_dir
+    return None
+
+
+def check_project_snapshot(name, project):
+    data_dir = project_snapshot_conflict(name, project)
+    if data_dir is not None:
+        status(f"{project} contains {data_dir}, leave the project out with --no-project")
+        sys.exit(1)
+
+
+def create_snapshot(name, include_project=True, keep=None):
+    sources = snapshot_sources(name, include_project)
+    if 'project' in sources:
+        check_project_snapshot(name, sources['project'])
+    target = snapshots_dir(name) / time.strftime('%Y%m%d-%H%M%S')
+    target.mkdir(parents=True)
+    running = is_running(get_containers()[1][name])
+
+    meta = {'created': time.time(), 'parts': {}}
+    if running:
+        run_podman('pause', name, quiet=True)
+    try:
+        for part, source in sources.items():
+            start = time.monotonic()
+            backend = clone_tree(source, target / part)
+            meta['parts'][part] = {'source': str(source), 'backend': backend, 'seconds': time.monotonic() - start}
+            status(f"Snapshot of {part} ({backend}) took {meta['parts'][part]['seconds']:.2f}s")
+    finally:
+        if running:
+            run_podman('unpause', name, quiet=True)
+    (target / 'meta.json').write_text(json.dumps(meta))
+    status(f"Created snapshot {target.name} of {name}")
+
+    if keep is not None:
+        prune_snapshots(name, keep)
+
+
+def list_snapshots(name):
+    # Oldest first, only complete snapshots (meta.json is written last)
+    base = snapshots_dir(name)
+    return sorted(s for s in base.iterdir() if (s / 'meta.json').exists()) if base.exists() else []
 
 
-ports_code = '''
-import json, psutil
-print(json.dumps([
-    {"ip": p.laddr.ip, "port": p.laddr.port, "type": p.type, "cmd": (psutil.Process(p.pid).cmdline() if p.pid is not None else None)}
-    for p in psutil.net_connections() if p.status == 'LISTEN'
-]))
-'''
+def restore_snapshot(name, snapshot=None, include_project=True, yes=False):
+    if get_containers()[1][name]['State'] in ('running', 'paused'):
+        status("Stop the container before restoring a snapshot")
+        sys.exit(1)
+    snapshots = list_snapshots(name)
+    matching = [s for s in snapshots if snapshot is None or s.name == snapshot]
+    if not matching:
+        status(f"No snapshot {snapshot or ''} found for {name}")
+        sys.exit(1)
+    source = matching[-1]
+    meta = json.loads((source / 'meta.json').read_text())
+    project = meta['parts'].get('project') if include_project else None
+    if project is not None:
+        check_project_snapshot(name, project['source'])
+        # Anything written to the project since the snapshot is lost
+        if not yes and input(f"Replace the contents of {project['source']} with snapshot {source.name}? [y/N] ").strip().lower() != 'y':
+            return
+
+    for part, info in meta['parts'].items():
+        if part == 'project' and not include_project:
+            continue
+        start = time.monotonic()
+        # Replace the contents, not the directory itself: it may be a subvolume or a mount point
+        subprocess.run([podman_binary, 'unshare', 'find', info['source'], '-mindepth', '1', '-delete'], check=True)
+        subprocess.run([podman_binary, 'unshare', 'cp', '-a', '--reflink=auto', f"{source / part}/.", info['source']], check=True)
+        status(f"Restored {part} in {time.monotonic() - start:.2f}s")
+    invalidate_size(name)
+    status(f"Restored {name} to snapshot {source.name}")
+
+
+def prune_snapshots(name, keep):
+    for snapshot in list_snapshots(name)[:-keep or None]:
+        for part in snapshot.iterdir():
+            if part.is_dir():
+                remove_tree(part)
+        shutil.rmtree(snapshot)
+        status(f"Removed snapshot {snapshot.name}")
+
+
+def schedule_snapshots(name, every, keep=None, include_project=True):
+    # A systemd user timer, so snapshots also happen while probox isn't running
+    units = Path(os.getenv("XDG_CONFIG_HOME", Path.home() / ".config")) / 'systemd/user'
+    unit = f'probox-snapshot-{name}'
+    if every == 'off':
+        subprocess.run(['systemctl', '--user', 'disable', '--now', f'{unit}.timer'], check=False)
+        (units / f'{unit}.timer').unlink(missing_ok=True)
+        (units / f'{unit}.service').unlink(missing_ok=True)
+        return
+
+    units.mkdir(parents=True, exist_ok=True)
+    keep_args = f' --keep {keep}' if keep is not None else ''
+    keep_args += '' if include_project else ' --no-project'
+    (units / f'{unit}.service').write_text(
+        f"[Unit]\nDescription=probox snapshot of {name}\n\n"
+        f"[Service]\nType=oneshot\nExecStart={sys.executable} {Path(__file__).absolute()} snapshot create {name}{keep_args}\n"
+    )
+    (units / f'{unit}.timer').write_text(
+        f"[Unit]\nDescription=Scheduled probox snapshots of {name}\n\n"
+        f"[Timer]\nOnCalendar={every}\nPersistent=true\n\n[Install]\nWantedBy=timers.target\n"
+    )
+    subprocess.run(['systemctl', '--user', 'daemon-reload'], check=True)
+    subprocess.run(['systemctl', '--user', 'enable', '--now', f'{unit}.timer'], check=True)
+    status(f"Scheduled snapshots of {name} ({every})")
+
+
+def snapshot(path_or_name, operation, snapshot_name=None, keep=None, every='daily', include_project=True, yes=False):
+    containers_by_path, containers_by_name = get_containers()
+    container_name = find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name)
+    if operation == 'create':
+        create_snapshot(container_name, include_project, keep)
+    elif operation == 'list':
+        rows = []
+        for s in list_snapshots(container_name):
+            meta = json.loads((s / 'meta.json').read_text())
+            parts = ', '.join(f"{part} ({info['backend']}, {info['seconds']:.1f}s)" for part, info in meta['parts'].items())
+            rows.append([s.name, time.strftime('%Y-%m-%d %H:%M', time.localtime(meta['created'])), parts])
+        print_table(['SNAPSHOT', 'CREATED', 'PARTS'], rows)
+    elif operation == 'restore':
+        restore_snapshot(container_name, snapshot_name, include_project, yes)
+    elif operation == 'prune':
+        prune_snapshots(container_name, keep if keep is not None else 5)
+    else:
+        if include_project:
+            check_project_snapshot(container_name, containers_by_name[container_name]['Labels']['probox.project_path'])
+        schedule_snapshots(container_name, every, keep, include_project)
 
 
 detect_services = {
@@ -413,31 +2248,362 @@ detect_services = {
 }
 
 
-def ports():
-    # Podman doesn't track the auto-forwarded ports pasta handles, so we look for them ourselves
-    running_containers = capture_podman('ps', '--filter', 'label=probox.project_path')
-    for c in running_containers:
-        name = c['Names'][0]
-        # TODO: understand why we need --privileged exactly? Sometimes the PID is None (even though running equivalent code
-        # in a shell *does* give the PID)
-        open_ports = capture_podman('exec', '--privileged', name, 'python3', '-c', ports_code, format_json=False)
-        print(f"- {c['Names'][0]}")
-        for p in open_ports:
-            service = detect_services.get(tuple(p['cmd']))
+# Two layers on top of the base image, so the drivers have something to copy up (or copy entirely, for vfs)
+bench_containerfile = """FROM {image}
+RUN dd if=/dev/zero of=/probox-bench bs=1M count=64 status=none
+RUN rm /probox-bench
+"""
+
+
+def bench_pinp(drivers=None, image='docker.io/library/alpine', from_image=None):
+    # Times nested pull, build and run in a throwaway box per driver
+    results = []
+    for driver in drivers or list(pinp_drivers):
+        random_id = ''.join(random.choice('0123456789ABCDEF') for i in range(6))
+        name = f'pbb-{driver}-{random_id}'
+        pinp_storage_id = f'{name}-storage'
+        proj_path = Path(tempfile.mkdtemp(prefix='probox-bench-'))
+        nested = [
+            'exec', '-i', '--user', getpass.getuser(), '--env', f'XDG_RUNTIME_DIR=/run/user/{os.getuid()}',
+            '--workdir', str(proj_path), name, 'podman',
+        ]
+        steps = [
+            ('pull', ['pull', '-q', image], None),
+            ('build', ['build', '-q', '--no-cache', '-t', 'probox-bench', '-f', '-', str(proj_path)], bench_containerfile.format(image=image)),
+            ('run', ['run', '--rm', 'probox-bench', 'true'], None),
+        ]
+        timings = {}
+        try:
+            create(
+                path=proj_path, name=name, from_image=from_image, push_overlay=False, ignore_existing_containers=True,
+                pinp_storage_id=pinp_storage_id, pinp_driver=driver
+            )
+            start_container(name)
+            for step, args, input in steps:
+                start = time.monotonic()
+                if run_podman(*nested, *args, input=input, check=False, quiet=True).returncode != 0:
+                    status(f"Nested podman {step} failed with {driver}")
+                    break
+                timings[step] = time.monotonic() - start
+        finally:
+            run_podman('rm', '--force', '--time', '0', name, check=False, quiet=True)
+            if ssh_agent_pid(name) is not None:
+                stop_ssh_agent(name)
+            for storage in [pinp_storage_id, f'{pinp_storage_id}-{getpass.getuser()}']:
+                remove_tree(probox_data_dir() / storage)
+            (probox_data_dir() / f'{pinp_storage_id}-storage.conf').unlink(missing_ok=True)
+            proj_path.rmdir()
+        results.append([driver, *(f'{timings[step]:.1f}s' if step in timings else 'failed' for step, args, input in steps)])
+
+    print_table(['DRIVER', *(step.upper() for step, args, input in steps)], results)
+
+
+def bench_exec(path_or_name, count=20):
+    # Latency of running `true` in the box, through the exec agent and through podman exec
+    containers_by_path, containers_by_name = get_containers()
+    name = find_container_name_by_path_or_name(containers_by_path, containers_by_name, path_or_name)
+    if 'probox.exec_agent' not in containers_by_name[name]['Labels']:
+        status(f"{name} was created without exec_agent = true in the config")
+        sys.exit(1)
+    if not is_running(containers_by_name[name]):
+        start_container(name)
+    start_exec_agent(name)
+
+    print_latencies({
+        'exec agent': lambda: exec_agent_run(name, ['true'], {}, Path.home(), use_pty=False),
+        'podman exec': lambda: subprocess.run([podman_binary, 'exec', '--user', getpass.getuser(), name, 'true']).returncode,
+    }, count)
+
+
+def bench_api(count=20):
+    # Latency of the queries probox makes most, through the podman service and through the podman binary
+    if not config.get('podman_socket'):
+        status("Set podman_socket in the config to compare with the podman service")
+        sys.exit(1)
+    methods = {}
+    for args in [('container', 'ls', '--all', '--filter', 'label=probox.project_path'), ('image', 'ls', '--all')]:
+        query = ' '.join(args[:2])
+        methods[f'{query} (service)'] = lambda args=args: 0 if capture_podman_api(args) is not None else 1
+        methods[f'{query} (binary)'] = lambda args=args: subprocess.run([podman_binary, *args, '--format', 'json'], capture_output=True).returncode
+    print_latencies(methods, count)
+
+
+def print_latencies(methods, count):
+    rows = []
+    for method, func in methods.items():
+        times = []
+        for i in range(count):
+            start = time.monotonic()
+            if func() != 0:
+                status(f"Running through {method} failed")
+                sys.exit(1)
+            times.append((time.monotonic() - start) * 1000)
+        rows.append([method, f'{sum(times) / count:.1f}ms', f'{min(times):.1f}ms', f'{max(times):.1f}ms'])
+    print_table(['METHOD', 'MEAN', 'MIN', 'MAX'], rows)
+
+
+def bench(what, path_or_name=None, drivers=None, image='docker.io/library/alpine', from_image=None, count=20):
+    match what:
+        case 'pinp':
+            bench_pinp(drivers, image, from_image)
+        case 'exec':
+            bench_exec(path_or_name, count)
+        case 'api':
+            bench_api(count)
+
+
+def decode_proc_address(address):
+    ip_hex, port_hex = address.split(':')
+    raw = bytes.fromhex(ip_hex)
+    # /proc/net stores addresses as 32-bit words in host (little endian) byte order
+    raw = b''.join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    return socket.inet_ntop(socket.AF_INET if len(raw) == 4 else socket.AF_INET6, raw), int(port_hex, 16)
+
+
+def listening_sockets(pid):
+    # Reads the sockets of the network namespace pid lives in, returns {inode: (proto, ip, port)}
+    sockets = {}
+    for table in ['tcp', 'tcp6', 'udp', 'udp6']:
+        try:
+            lines = Path(f'/proc/{pid}/net/{table}').read_text().splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            local, remote, state, inode = fields[1], fields[2], fields[3], int(fields[9])
+            # TCP: state LISTEN, UDP: bound but not connected
+            if (state == '0A' if table.startswith('tcp') else decode_proc_address(remote)[1] == 0):
+                sockets[inode] = (table.rstrip('6'), *decode_proc_address(local))
+    return sockets
+
+
+def socket_owners():
+    # Maps socket inodes to command lines, for every process we're allowed to look at (the ones running
+    # as our own user, other users in the container map to subuids)
+    owners = {}
+    for proc in Path('/proc').iterdir():
+        if not proc.name.isdigit():
+            continue
+        try:
+            fds = list((proc / 'fd').iterdir())
+            cmd = (proc / 'cmdline').read_text().rstrip('\0').split('\0')
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(fd)
+            except OSError:  # closed in the meantime
+                continue
+            if target.startswith('socket:['):
+                owners[int(target[8:-1])] = cmd
+    return owners
+
+
+def scan_ports():
+    # Podman doesn't track the auto-forwarded ports pasta handles, so we look for them ourselves, straight
+    # from the container's network namespace on the host (no exec needed)
+    running = [c['Names'][0] for c in list_containers() if is_running(c)]
+    if not running:
+        return {}
+    pids = {c['Name']: c['State']['Pid'] for c in capture_podman('container', 'inspect', *running)}
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        owners_future = pool.submit(socket_owners)
+        sockets = dict(zip(pids, pool.map(listening_sockets, pids.values())))
+        owners = owners_future.result()
+
+    found = {}
+    for name, container_sockets in sockets.items():
+        found[name] = set()
+        for inode, (proto, ip, port) in container_sockets.items():
+            cmd = owners.get(inode)
+            service = detect_services.get(tuple(cmd or ()))
             if service is not None:
-                name, proto = service
+                service_name, scheme = service
+            else:
+                service_name = Path(cmd[0]).name if cmd else '?'
+                scheme = 'http' if proto == 'tcp' else proto  # not all TCP is HTTP, but most?
+            found[name].add((port, scheme, service_name))
+    return found
+
+
+def inbound_connections(pid):
+    # Established TCP connections to one of the ports the box listens on (e.g. an open code-server tab)
+    listening = {(ip, port) for proto, ip, port in listening_sockets(pid).values() if proto == 'tcp'}
+    listening_ports = {port for ip, port in listening}
+    count = 0
+    for table in ['tcp', 'tcp6']:
+        try:
+            lines = Path(f'/proc/{pid}/net/{table}').read_text().splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if fields[3] == '01' and decode_proc_address(fields[1])[1] in listening_ports:
+                count += 1
+    return count
+
+
+def cgroup_cpu_usage(pid):
+    # CPU time (in µs) used by the whole container, i.e. its libpod scope rather than the cgroup of init
+    cgroup = Path('/sys/fs/cgroup') / Path(f'/proc/{pid}/cgroup').read_text().strip().split('::', 1)[1].lstrip('/')
+    for candidate in [cgroup, *cgroup.parents]:
+        if candidate.name.startswith('libpod-'):
+            cgroup = candidate
+            break
+    for line in (cgroup / 'cpu.stat').read_text().splitlines():
+        key, value = line.split()
+        if key == 'usage_usec':
+            return int(value)
+    return 0
+
+
+def check_idle():
+    # A box is active when someone is exec'ed into it, connected to one of its ports, or it uses CPU
+    state_file = probox_runtime_dir() / 'idle.json'
+    try:
+        state = json.loads(state_file.read_text())
+    except (OSError, ValueError):
+        state = {}
+
+    now = time.time()
+    running = [c['Names'][0] for c in list_containers() if is_running(c)]
+    new_state = {}
+    for data in (capture_podman('container', 'inspect', *running) if running else []):
+        name, pid = data['Name'], data['State']['Pid']
+        entry = state.get(name, {'active': now})
+        exec_ids, agent_busy = set(data['ExecIDs']), False
+        if 'probox.exec_agent' in data['Config']['Labels']:
+            # The agent's own session doesn't count, the runs it serves do
+            agent_id_file = exec_agent_state_file(name, 'id')
+            if agent_id_file.exists():
+                exec_ids.discard(agent_id_file.read_text())
+            agent_busy = exec_agent_busy(name)
+        try:
+            cpu = cgroup_cpu_usage(pid)
+        except OSError:
+            cpu = None
+        cpu_percent = 0
+        if cpu is not None and entry.get('cpu') is not None and now > entry['checked']:
+            cpu_percent = (cpu - entry['cpu']) / 1e6 / (now - entry['checked']) * 100
+        if exec_ids or agent_busy or inbound_connections(pid) or cpu_percent > config.get('idle_cpu_percent', 2):
+            entry['active'] = now
+
+        timeout = config.get('idle_timeouts', {}).get(name, config.get('idle_timeout', 0))
+        if timeout and now - entry['active'] > timeout:
+            status(f"{name} has been idle for {format_age(now - entry['active'])}")
+            action = config.get('idle_action', 'stop')
+            if action == 'pause':
+                run_podman('pause', name, quiet=True)
+            else:
+                stop_container(name, checkpoint=action == 'checkpoint')
+            continue
+        new_state[name] = {**entry, 'cpu': cpu, 'checked': now}
+
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    state_file.write_text(json.dumps(new_state))
+
+
+def idle(watch=False, interval=60):
+    try:
+        while True:
+            check_idle()
+            if not watch:
+                return
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def format_port(port, scheme, service_name):
+    return f"{scheme}://127.0.0.1:{port}/  ({service_name})"
+
+
+def ports(watch=False, interval=2):
+    previous = None
+    try:
+        while True:
+            current = scan_ports()
+            if previous is None:
+                for name, found in current.items():
+                    print(f"- {name}")
+                    for p in sorted(found):
+                        print(f"   - {format_port(*p)}")
             else:
-                name = Path(p['cmd'][0]).name
-                proto = 'http' if p['type'] == socket.SOCK_STREAM else ''  # not all TCP is HTTP, but most?
-            print(f"   - {proto}://127.0.0.1:{p['port']}/  ({name})")
+                for name in sorted(current.keys() | previous.keys()):
+                    for p in sorted(current.get(name, set()) - previous.get(name, set())):
+                        print(f"+ {name}: {format_port(*p)}")
+                    for p in sorted(previous.get(name, set()) - current.get(name, set())):
+                        print(f"- {name}: {format_port(*p)}")
+            sys.stdout.flush()
+            if not watch:
+                return
+            previous = current
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+trace_events = []
+trace_started = None
+
+
+class TracedPopen(subprocess.Popen):
+    # Replaces subprocess.Popen while tracing, so every spawned process is recorded once it's waited for
+    def __init__(self, args, *pargs, **kwargs):
+        self.trace_start = time.monotonic()
+        self.trace_thread = threading.get_native_id()
+        self.trace_recorded = False
+        super().__init__(args, *pargs, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if not self.trace_recorded:
+            self.trace_recorded = True
+            argv = [str(a) for a in ([self.args] if isinstance(self.args, (str, bytes, os.PathLike)) else self.args)]
+            record_trace(' '.join([Path(argv[0]).name, *argv[1:]])[:60], 'subprocess', self.trace_start, self.trace_thread, argv=argv, returncode=returncode)
+        return returncode
+
+
+def record_trace(name, category, start, thread, **args):
+    trace_events.append({
+        'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': thread,
+        'ts': round((start - trace_started) * 1e6),
+        'dur': round((time.monotonic() - start) * 1e6),
+        'args': args,
+    })
+
+
+def start_trace():
+    global trace_started
+    trace_started = time.monotonic()
+    subprocess.Popen = TracedPopen
+
+
+def write_trace(trace_file, command):
+    # Chrome trace event format, open it in about:tracing or https://ui.perfetto.dev
+    duration = time.monotonic() - trace_started
+    events = [
+        {'name': f'probox {command}', 'cat': 'command', 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_native_id(), 'ts': 0, 'dur': round(duration * 1e6)},
+        *({**e, 'args': {**e['args'], 'subcommand': command}} for e in trace_events),
+    ]
+    Path(trace_file).write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+    slowest = sorted(trace_events, key=lambda e: e['dur'], reverse=True)[:10]
+    status(f"{command} took {duration:.2f}s, {len(trace_events)} podman/subprocess calls took {sum(e['dur'] for e in trace_events) / 1e6:.2f}s, trace written to {trace_file}")
+    print_table(
+        ['STEP', 'START', 'TIME', 'EXIT'],
+        [[e['name'], f"{e['ts'] / 1e6:.2f}s", f"{e['dur'] / 1e6:.2f}s", e['args']['returncode']] for e in slowest],
+        file=sys.stderr
+    )
 
 
 def main():
     global config
 
     parser = argparse.ArgumentParser(prog="probox", description="Manage containers for your development projects (with podman).")
+    parser.add_argument('--trace', metavar='FILE', help="Record all spawned processes to FILE (Chrome trace format) and print the slowest (or set PROBOX_TRACE=FILE)")
 
-    subparsers = parser.add_subparsers()
+    subparsers = parser.add_subparsers(dest='command')
 
     create_parser = subparsers.add_parser('create', help="Create a new container (box) for your project")
     create_parser.add_argument('path', nargs='?', default=None, help="Path to attach to container (default = working dir)")
@@ -445,8 +2611,10 @@ def main():
     create_parser.add_argument('--from', help="Container image to base this one upon")
     create_parser.add_argument('--no-overlay', action="store_true", help="Disable initial push of overlay files")
     create_parser.add_argument('--privileged', action="store_true", help="Make container privileged (not secure, but makes nested podman possible)")
+    create_parser.add_argument('--pinp-driver', choices=list(pinp_drivers), help="Storage driver for nested podman (default = pinp_storage_driver in config)")
     create_parser.set_defaults(func=lambda args: create(
-        path=args.path, name=args.name, from_image=getattr(args, 'from'), privileged=args.privileged, push_overlay=not args.no_overlay
+        path=args.path, name=args.name, from_image=getattr(args, 'from'), privileged=args.privileged, push_overlay=not args.no_overlay,
+        pinp_driver=args.pinp_driver
     ))
 
     run_parser = subparsers.add_parser('run', help="Run an existing container (start and exec)")
@@ -465,39 +2633,127 @@ def main():
         path=args.path, from_image=getattr(args, 'from'), privileged=args.privileged, push_overlay=not args.no_overlay
     ))
 
+    start_parser = subparsers.add_parser('start', help="Start a container (and its ssh-agent) without running anything in it")
+    start_parser.add_argument('path_or_name', nargs='?', default=None, help="Path, name or name pattern of container (default = working dir)")
+    add_selector_arguments(start_parser)
+    start_parser.set_defaults(func=lambda args: start(path_or_name=args.path_or_name, all_boxes=args.all_boxes, labels=args.label, jobs=args.jobs))
+
+    pool_parser = subparsers.add_parser('pool', help="Manage the pool of ready-to-use containers for `temp` (see temp_pool in config)")
+    pool_parser.add_argument('operation', choices=['status', 'fill', 'clear', 'release'], help="release: remove a claimed container")
+    pool_parser.add_argument('name', nargs='?', help="Container to release")
+    pool_parser.set_defaults(func=lambda args: pool(args.operation, args.name))
+
     stop_parser = subparsers.add_parser('stop', help="Stop a container")
-    stop_parser.add_argument('path_or_name', nargs='?', default=None, help="Path or name of container (default = working dir)")
-    stop_parser.set_defaults(func=lambda args: stop(path_or_name=args.path_or_name))
+    stop_parser.add_argument('path_or_name', nargs='?', default=None, help="Path, name or name pattern of container (default = working dir)")
+    stop_parser.add_argument('--checkpoint', action="store_true", help="Checkpoint the container (CRIU) so `run` can restore it as it was")
+    add_selector_arguments(stop_parser)
+    stop_parser.set_defaults(func=lambda args: stop(
+        path_or_name=args.path_or_name, all_boxes=args.all_boxes, labels=args.label, jobs=args.jobs, checkpoint=args.checkpoint
+    ))
+
+    upgrade_parser = subparsers.add_parser('upgrade', help="Recreate a container from a fresh base image, keeping your changes")
+    upgrade_parser.add_argument('path_or_name', nargs='?', default=None, help="Path or name of container (default = working dir)")
+    upgrade_parser.add_argument('--from', help="Container image to base the new container upon (default = the current one)")
+    upgrade_parser.add_argument('--keep-old', action="store_true", help="Keep the old container (renamed to <name>-preupgrade)")
+    upgrade_parser.set_defaults(func=lambda args: upgrade(path_or_name=args.path_or_name, from_image=getattr(args, 'from'), keep_old=args.keep_old))
+
+    apply_parser = subparsers.add_parser('apply', help="Create the containers declared in a manifest ([[box]] tables with path, name, image, privileged, overlay)")
+    apply_parser.add_argument('manifest', help="TOML file declaring the containers")
+    apply_parser.add_argument('--yes', action="store_true", help="Don't ask for confirmation")
+    apply_parser.add_argument('--jobs', type=int, default=4, help="Number of containers to create at the same time (default = 4)")
+    apply_parser.set_defaults(func=lambda args: apply(args.manifest, yes=args.yes, jobs=args.jobs))
 
     ssh_add_parser = subparsers.add_parser('ssh-add', help="Add key to ssh-agent for project (tip: use -c to confirm usage in host)")
-    ssh_add_parser.add_argument('path_or_name', help="Path or name of container")
+    ssh_add_parser.add_argument('--all', action="store_true", dest='all_boxes', help="Select all containers (then all arguments go to ssh-add, put -- before options)")
+    ssh_add_parser.add_argument('--label', action="append", default=[], help="Select containers with this label (key or key=value, repeatable)")
+    ssh_add_parser.add_argument('path_or_name', nargs='?', help="Path, name or name pattern of container")
     ssh_add_parser.add_argument('args', nargs=argparse.REMAINDER, help="Arguments passed to ssh-add")
-    ssh_add_parser.set_defaults(func=lambda args: ssh_add(path_or_name=args.path_or_name, args=args.args))
+    ssh_add_parser.set_defaults(func=lambda args: ssh_add(path_or_name=args.path_or_name, args=args.args, all_boxes=args.all_boxes, labels=args.label))
 
     name_parser = subparsers.add_parser('name', help="Get name of container attached to directory")
     name_parser.add_argument('path_or_name', nargs='?', default=None, help="Path or name of container (default = working dir)")
     name_parser.set_defaults(func=lambda args: name(path_or_name=args.path_or_name))
 
     ls_parser = subparsers.add_parser('ls', help="List all probox containers")
-    ls_parser.set_defaults(func=lambda args: ls())
+    ls_parser.add_argument('--size', action="store_true", help="Show (cached) disk usage, including PINP storage")
+    ls_parser.set_defaults(func=lambda args: ls(size=args.size))
+
+    du_parser = subparsers.add_parser('du', help="Show (cached) disk usage of containers, their PINP storage and derived images")
+    du_parser.add_argument('--refresh', action="store_true", help="Measure again before showing")
+    du_parser.set_defaults(func=lambda args: du(refresh=args.refresh))
 
     overlay_parser = subparsers.add_parser('overlay', help="Manage overlay files (useful for configs/dotfiles/...)")
     overlay_parser.add_argument("operation", choices=["push", "pull"])
-    overlay_parser.add_argument('path_or_name', nargs='?', help="Path or name of container (default = working dir)")
+    overlay_parser.add_argument('path_or_name', nargs='?', help="Path, name or name pattern of container (default = working dir)")
     overlay_parser.add_argument('file', nargs='*', help="File to push or pull")
+    overlay_parser.add_argument('--force', action="store_true", help="Also overwrite files that changed on the other side")
+    add_selector_arguments(overlay_parser)
     overlay_parser.set_defaults(func=lambda args: overlay(
-        path_or_name=args.path_or_name, operation=args.operation, files=args.file
+        path_or_name=args.path_or_name, operation=args.operation, files=args.file, force=args.force,
+        all_boxes=args.all_boxes, labels=args.label, jobs=args.jobs
+    ))
+
+    image_parser = subparsers.add_parser('image', help="Manage the images probox derives from base images")
+    image_parser.add_argument('operation', choices=['refresh', 'gc'], help="refresh: pull base images and prebuild derived images (then gc), gc: remove stale derived images")
+    image_parser.add_argument('--jobs', type=int, default=4, help="Number of images to refresh in parallel")
+    image_parser.set_defaults(func=lambda args: refresh_images(jobs=args.jobs) if args.operation == 'refresh' else gc_images())
+
+    store_parser = subparsers.add_parser('store', help="Manage the image store shared by the nested podman of all boxes")
+    store_parser.add_argument('operation', choices=['pull', 'ls', 'report'])
+    store_parser.add_argument('image', nargs='*', help="Images to pull into the store")
+    store_parser.set_defaults(func=lambda args: image_store(args.operation, args.image))
+
+    snapshot_parser = subparsers.add_parser('snapshot', help="Snapshot a container, its PINP storage and its project directory")
+    snapshot_parser.add_argument('operation', choices=['create', 'list', 'restore', 'prune', 'schedule'])
+    snapshot_parser.add_argument('path_or_name', nargs='?', default=None, help="Path or name of container (default = working dir)")
+    snapshot_parser.add_argument('--snapshot', help="Snapshot to restore (default = latest)")
+    snapshot_parser.add_argument('--keep', type=int, help="Number of snapshots to keep (prune defaults to 5)")
+    snapshot_parser.add_argument('--every', default='daily', help="systemd OnCalendar spec for schedule, or 'off' (default = daily)")
+    snapshot_parser.add_argument('--no-project', action="store_true", help="Leave the project directory out")
+    snapshot_parser.add_argument('--yes', action="store_true", help="Don't ask for confirmation before restoring the project directory")
+    snapshot_parser.set_defaults(func=lambda args: snapshot(
+        path_or_name=args.path_or_name, operation=args.operation, snapshot_name=args.snapshot, keep=args.keep,
+        every=args.every, include_project=not args.no_project, yes=args.yes
+    ))
+
+    idle_parser = subparsers.add_parser('idle', help="Stop or pause idle containers (see idle_timeout in config), `run` resumes them")
+    idle_parser.add_argument('--watch', action="store_true", help="Keep checking (e.g. from a systemd user service)")
+    idle_parser.add_argument('--interval', type=float, default=60, help="Seconds between checks in --watch mode")
+    idle_parser.set_defaults(func=lambda args: idle(watch=args.watch, interval=args.interval))
+
+    cache_parser = subparsers.add_parser('cache', help="Manage the caches shared by all containers (see [caches] in config)")
+    cache_parser.add_argument('operation', choices=['ls', 'prune'])
+    cache_parser.add_argument('name', nargs='*', help="Caches to handle (default = all)")
+    cache_parser.add_argument('--days', type=int, default=30, help="prune removes files not accessed in this many days (default = 30)")
+    cache_parser.set_defaults(func=lambda args: cache(args.operation, args.name, args.days))
+
+    bench_parser = subparsers.add_parser('bench', help="Measure how fast probox and the containers are")
+    bench_parser.add_argument('what', choices=['pinp', 'exec', 'api'], help="pinp: nested podman pull/build/run for each PINP storage driver, exec: exec agent vs podman exec, api: podman service vs podman binary")
+    bench_parser.add_argument('path_or_name', nargs='?', default=None, help="Path or name of container for exec (default = working dir)")
+    bench_parser.add_argument('--drivers', nargs='+', choices=list(pinp_drivers), help="PINP storage drivers to compare (default = all)")
+    bench_parser.add_argument('--image', default='docker.io/library/alpine', help="Image to pull and build upon in the nested podman")
+    bench_parser.add_argument('--from', help="Container image for the benchmark containers")
+    bench_parser.add_argument('--count', type=int, default=20, help="Number of commands to run for exec and api")
+    bench_parser.set_defaults(func=lambda args: bench(
+        args.what, path_or_name=args.path_or_name, drivers=args.drivers, image=args.image, from_image=getattr(args, 'from'), count=args.count
     ))
 
+    token_parser = subparsers.add_parser('token', help="Access tokens handed to containers through ~/tokens.sock (see [tokens] in config)")
+    token_parser.add_argument('operation', choices=['ls', 'get', 'serve'], help="get: print a token (refreshed if needed), serve: run the broker of a container")
+    token_parser.add_argument('name', nargs='?', help="Token name (get) or container name (serve)")
+    token_parser.set_defaults(func=lambda args: token(args.operation, args.name))
+
     ports_parser = subparsers.add_parser('ports', help="List all exposed ports")
-    ports_parser.set_defaults(func=lambda args: ports())
+    ports_parser.add_argument('--watch', action="store_true", help="Keep running and show ports as they are opened and closed")
+    ports_parser.add_argument('--interval', type=float, default=2, help="Seconds between scans in --watch mode")
+    ports_parser.set_defaults(func=lambda args: ports(watch=args.watch, interval=args.interval))
 
     args = parser.parse_args()
-    if not any(vars(args).values()):
+    if args.command is None:
         parser.print_help()
         return
     else:
-        config_base = Path(os.getenv("XDG_CONFIG_HOME", Path.home() / ".config")) / 'probox'
+        config_base = probox_config_dir()
         config_base.mkdir(exist_ok=True, parents=True)
 
         config_file = config_base / 'probox.toml'
@@ -509,7 +2765,17 @@ def main():
 
         with config_file.open("rb") as f:
             config = tomllib.load(f)
-    args.func(args)
+
+    # Popped so the processes we spawn (like `probox pool fill`) don't overwrite our trace
+    trace_file = args.trace or os.environ.pop('PROBOX_TRACE', None)
+    if trace_file is None:
+        args.func(args)
+        return
+    start_trace()
+    try:
+        args.func(args)
+    finally:
+        write_trace(trace_file, args.command)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# Stand-in for the podman binary (set PROBOX_PODMAN to this file), so the command flow of probox can be run
+# and timed without containers. It knows about containers, images, labels, mounts and inspect output, just
+# enough of it for probox. Commands that would run inside a box run on the host instead, in a directory per
+# container that stands in for its rootfs (which is also what `mount` prints). Inside `unshare`, the rootfs
+# gets the host's /usr (beneath its own, through an overlay), so commands can be chrooted into it.
+#
+# FAKE_PODMAN_LOG: file to append every call to (one JSON list per line)
+# FAKE_PODMAN_LATENCY: seconds every call takes, on top of our own startup (default 0)
+#
+# The state lives next to podman's database, which we touch on every change, so the container list cache of
+# probox is invalidated like it is with the real podman.
+import fcntl
+import json
+import os
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+storage = Path(os.getenv('XDG_DATA_HOME', Path.home() / '.local/share')) / 'containers/storage'
+state_file = storage / 'fake-podman.json'
+
+
+def fail(message, code=125):
+    print(f'Error: {message}', file=sys.stderr)
+    sys.exit(code)
+
+
+@contextmanager
+def locked_state(write=False):
+    storage.mkdir(parents=True, exist_ok=True)
+    with open(storage / 'fake-podman.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = json.loads(state_file.read_text()) if state_file.exists() else {'containers': {}, 'images': {}}
+        yield state
+        if write:
+            state_file.write_text(json.dumps(state))
+            (storage / 'db.sql').touch()
+
+
+def rootfs(container):
+    return storage / 'fake-rootfs' / container['Id']
+
+
+# Like the merged /usr of Arch: the links the image brings, which diff doesn't report
+image_links = {link: os.readlink(f'/{link}') for link in ['bin', 'sbin', 'lib', 'lib64'] if os.path.islink(f'/{link}')}
+
+
+def find_container(state, name_or_id):
+    for container in state['containers'].values():
+        if name_or_id in (container['Name'], container['Id']) or (len(name_or_id) >= 12 and container['Id'].startswith(name_or_id)):
+            return container
+    fail(f'no container with name or ID "{name_or_id}" found: no such container')
+
+
+def image_matches(image, reference):
+    return reference in (image['Id'], image['Id'][:12]) or any(reference in (n, n.rsplit(':', 1)[0]) for n in image['Names'])
+
+
+def find_image(state, reference):
+    for image in state['images'].values():
+        if image_matches(image, reference):
+            return image
+    fail(f'{reference}: image not known')
+
+
+def label_filters(args):
+    # --filter label=key or label=key=value, the only filters probox uses
+    filters = []
+    while '--filter' in args:
+        i = args.index('--filter')
+        kind, _, value = args[i + 1].partition('=')
+        if kind != 'label':
+            fail(f'unsupported filter {kind}')
+        key, has_value, expected = value.partition('=')
+        filters.append((key, expected if has_value else None))
+        del args[i:i + 2]
+    return filters
+
+
+def has_labels(labels, filters):
+    return all(key in labels and (expected is None or labels[key] == expected) for key, expected in filters)
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except (OSError, TypeError):
+        return False
+
+
+def kill(container):
+    # Stopping a container ends its exec sessions too
+    for pid in [container['Pid'], *container['Execs'].values()]:
+        if pid > 0 and alive(pid):
+            os.kill(pid, signal.SIGTERM)
+    container['Execs'] = {}
+
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000000000Z', time.gmtime())
+
+
+def container_ls(args):
+    filters = label_filters(args)
+    with locked_state() as state:
+        containers = [c for c in state['containers'].values() if has_labels(c['Labels'], filters) and ('--all' in args or c['Status'] == 'running')]
+    # Newest first, like podman
+    print(json.dumps([{
+        'Id': c['Id'], 'Names': [c['Name']], 'State': c['Status'], 'Labels': c['Labels'], 'Image': c['ImageName'],
+        'ImageID': c['Image'], 'Created': c['Created'], 'Mounts': [m['Destination'] for m in c['Mounts']],
+    } for c in reversed(containers)]))
+
+
+def container_inspect(args):
+    with locked_state() as state:
+        containers = [find_container(state, name) for name in args if not name.startswith('--')]
+    print(json.dumps([{
+        'Id': c['Id'], 'Name': c['Name'], 'Image': c['Image'], 'ImageName': c['ImageName'],
+        'State': {
+            'Status': c['Status'], 'Running': c['Status'] == 'running', 'Paused': c['Status'] == 'paused',
+            'Pid': c['Pid'], 'StartedAt': c['StartedAt'], 'FinishedAt': c['FinishedAt'], 'Checkpointed': c['Checkpointed'],
+        },
+        'Config': {'Labels': c['Labels']},
+        'Mounts': [{'Type': 'bind', **m} for m in c['Mounts']],
+        'HostConfig': {'Privileged': c['Privileged']},
+        'GraphDriver': {'Name': 'overlay', 'Data': {'UpperDir': str(rootfs(c))}},
+        'ExecIDs': [exec_id for exec_id, pid in c['Execs'].items() if alive(pid)],
+    } for c in containers]))
+
+
+def create(args):
+    options = {'--name': None, '--label': [], '--volume': []}
+    flags = set()
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option in ('--name', '--hostname', '--label', '--volume', '--security-opt', '--env'):
+            value = args.pop(0)
+        elif '=' in option:
+            option, value = option.split('=', 1)
+        else:
+            flags.add(option)
+            continue
+        if isinstance(options.get(option), list):
+            options[option].append(value)
+        elif option in options:
+            options[option] = value
+    if not args:
+        fail('an image is required')
+
+    with locked_state(write=True) as state:
+        image = find_image(state, args[0])
+        name = options['--name'] or f'fake_{secrets.token_hex(4)}'
+        if any(c['Name'] == name for c in state['containers'].values()):
+            fail(f'creating container storage: the container name "{name}" is already in use')
+        mounts = []
+        for volume in options['--volume']:
+            source, destination = volume.split(':')[:2]
+            mounts.append({'Source': source, 'Destination': destination})
+        container = {
+            'Id': secrets.token_hex(32), 'Name': name, 'Image': image['Id'], 'ImageName': args[0],
+            'Labels': {**image['Labels'], **dict(label.split('=', 1) for label in options['--label'])},
+            'Mounts': mounts, 'Privileged': '--privileged' in flags, 'Remove': '--rm' in flags,
+            'Status': 'created', 'Pid': 0, 'Created': int(time.time()), 'StartedAt': '0001-01-01T00:00:00Z',
+            'FinishedAt': '0001-01-01T00:00:00Z', 'Checkpointed': False, 'Execs': {},
+        }
+        state['containers'][container['Id']] = container
+        # Like the images setup_user made, with a home directory for the user
+        (rootfs(container) / str(Path.home()).lstrip('/')).mkdir(parents=True)
+        (rootfs(container) / 'usr').mkdir()
+        for link, target in image_links.items():
+            (rootfs(container) / link).symlink_to(target)
+    print(container['Id'])
+
+
+def set_status(args, status):
+    names = [a for a in args if not a.startswith('-')]
+    with locked_state(write=True) as state:
+        for name in names:
+            container, new_status = find_container(state, name), status
+            if status == 'running' and container['Status'] not in ('running', 'paused'):
+                # Stands in for the container's init, so there is a network namespace and cgroup to look at. The
+                # namespace is its own where unprivileged ones are allowed, so host connections don't count as the box's
+                init = ['sleep', 'infinity']
+                if shutil.which('unshare') and subprocess.run(['unshare', '-rn', 'true'], stderr=subprocess.DEVNULL).returncode == 0:
+                    init = ['unshare', '-rn', *init]
+                container['Pid'] = subprocess.Popen(init, start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).pid
+                # File mounts as hard links, which like bind mounts stick to the file that was there on start
+                for mount in container['Mounts']:
+                    source, target = Path(mount['Source']), rootfs(container) / mount['Destination'].lstrip('/')
+                    if source.is_file() and not source.is_symlink():
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        target.unlink(missing_ok=True)
+                        try:
+                            os.link(source, target)
+                        except OSError:
+                            shutil.copy2(source, target)
+                container['StartedAt'], container['Checkpointed'] = now(), False
+            elif status == 'checkpointed' and container['Status'] != 'running':
+                fail(f'"{name}" is not running, can\'t checkpoint it')
+            elif status in ('exited', 'checkpointed') and container['Status'] in ('running', 'paused'):
+                kill(container)
+                container['Pid'], container['FinishedAt'] = 0, now()
+                container['Checkpointed'], new_status = status == 'checkpointed', 'exited'
+                if container['Remove']:
+                    shutil.rmtree(rootfs(container), ignore_errors=True)
+                    del state['containers'][container['Id']]
+                    print(name)
+                    continue
+            elif status == 'paused' and container['Status'] != 'running':
+                fail(f'"{name}" is not running, can\'t pause it')
+            container['Status'] = new_status
+            print(name)
+
+
+def rm(args):
+    force = '--force' in args or '-f' in args
+    if '--time' in args:
+        del args[args.index('--time'):args.index('--time') + 2]
+    names = [a for a in args if not a.startswith('-')]
+    with locked_state(write=True) as state:
+        for name in names:
+            container = find_container(state, name)
+            if container['Status'] in ('running', 'paused') and not force:
+                fail(f'cannot remove container {name} as it is running - running or paused containers cannot be removed without force', 2)
+            kill(container)
+            shutil.rmtree(rootfs(container), ignore_errors=True)
+            del state['containers'][container['Id']]
+            print(name)
+
+
+def rename(args):
+    with locked_state(write=True) as state:
+        container = find_container(state, args[0])
+        if any(c['Name'] == args[1] for c in state['containers'].values()):
+            fail(f'the container name "{args[1]}" is already in use')
+        container['Name'] = args[1]
+
+
+def commit(args):
+    names = [a for a in args if not a.startswith('-')]
+    with locked_state(write=True) as state:
+        container = find_container(state, names[0])
+        image = {'Id': secrets.token_hex(32), 'Names': [names[1]] if len(names) > 1 else [], 'Labels': dict(container['Labels']), 'Created': int(time.time())}
+        state['images'][image['Id']] = image
+    print(image['Id'])
+
+
+def exec_(args):
+    interactive = detach = False
+    env, workdir = {}, '/'
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option in ('--user', '-u'):
+            args.pop(0)
+        elif option in ('--workdir', '-w'):
+            workdir = args.pop(0)
+        elif option in ('--env', '-e'):
+            key, _, value = args.pop(0).partition('=')
+            env[key] = value
+        elif option == '--env-file':
+            for line in Path(args.pop(0)).read_text().splitlines():
+                key, _, value = line.partition('=')
+                env[key] = value
+        else:
+            interactive |= 'i' in option
+            detach |= 'd' in option
+    with locked_state() as state:
+        container = find_container(state, args.pop(0))
+    if container['Status'] != 'running':
+        fail('can only create exec sessions on running containers: container state improper')
+
+    cwd = rootfs(container) / workdir.lstrip('/')
+    cwd.mkdir(parents=True, exist_ok=True)
+    options = dict(cwd=cwd, env={**os.environ, **env}, stdin=None if interactive else subprocess.DEVNULL)
+    if not detach:
+        sys.exit(subprocess.run(args, **options).returncode)
+    exec_id = secrets.token_hex(32)
+    process = subprocess.Popen(args, start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **options)
+    with locked_state(write=True) as state:
+        state['containers'][container['Id']]['Execs'][exec_id] = process.pid
+    print(exec_id)
+
+
+def mount(args):
+    with locked_state() as state:
+        container = find_container(state, args[0])
+    root = rootfs(container)
+    if os.getenv('FAKE_PODMAN_UNSHARED') and not os.path.ismount(root / 'usr'):
+        # Only in the mount namespace of this `unshare`, writes to /usr still end up in the rootfs
+        work = storage / 'fake-work' / container['Id']
+        shutil.rmtree(work, ignore_errors=True)
+        work.mkdir(parents=True)
+        subprocess.run(['mount', '-t', 'overlay', 'overlay', '-o', f'lowerdir=/usr,upperdir={root / "usr"},workdir={work}', str(root / 'usr')], check=True)
+    print(root)
+
+
+def diff(args):
+    with locked_state() as state:
+        container = find_container(state, args[0])
+    root = rootfs(container)
+    added = sorted('/' + str(p.relative_to(root)) for p in root.rglob('*') if str(p.relative_to(root)) not in [*image_links, 'usr'])
+    # There is no image to compare with, tests list the image's files that a box deleted here
+    deleted_file = storage / 'fake-deleted' / container['Id']
+    deleted = deleted_file.read_text().split() if deleted_file.exists() else []
+    print(json.dumps({'changed': [], 'added': added, 'deleted': deleted}))
+
+
+def image_ls(args):
+    filters = label_filters(args)
+    references = [a for a in args if not a.startswith('-') and a != 'json']
+    with locked_state() as state:
+        images = [i for i in state['images'].values() if has_labels(i['Labels'], filters) and all(image_matches(i, r) for r in references)]
+    print(json.dumps([{'Id': i['Id'], 'Names': i['Names'], 'Labels': i['Labels'], 'Created': i['Created'], 'Size': 1 << 20} for i in images]))
+
+
+def image_inspect(args):
+    with locked_state() as state:
+        images = [find_image(state, reference) for reference in args if not reference.startswith('-') and reference != 'json']
+    print(json.dumps([{'Id': i['Id'], 'RepoTags': i['Names'], 'Config': {'Labels': i['Labels']}} for i in images]))
+
+
+def image_rm(args):
+    with locked_state(write=True) as state:
+        for reference in [a for a in args if not a.startswith('-')]:
+            image = find_image(state, reference)
+            if any(c['Image'] == image['Id'] for c in state['containers'].values()):
+                fail(f'image used by a container: {reference}', 2)
+            del state['images'][image['Id']]
+
+
+def pull(args):
+    reference = [a for a in args if not a.startswith('-')][0]
+    name = reference if ':' in reference.rsplit('/', 1)[-1] else reference + ':latest'
+    with locked_state(write=True) as state:
+        for image in state['images'].values():
+            if name in image['Names']:
+                break
+        else:
+            # Base images come with a (harmless) setup script, like arch-with-code-server has
+            image = {'Id': secrets.token_hex(32), 'Names': [name], 'Labels': {'probox.setup_user': 'true'}, 'Created': int(time.time())}
+            state['images'][image['Id']] = image
+    print(image['Id'])
+
+
+def main(args):
+    log = os.getenv('FAKE_PODMAN_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write(json.dumps(args) + '\n')
+    time.sleep(float(os.getenv('FAKE_PODMAN_LATENCY', '0')))
+
+    if args and args[0] == 'unshare':
+        # We already are "root" in the user namespace as far as the fake rootfs is concerned, the new one is
+        # for the mount namespace that mount needs
+        os.environ['FAKE_PODMAN_UNSHARED'] = '1'
+        os.execvp('unshare', ['unshare', '-rm', '--', *args[1:]])
+    if '--format' in args:
+        i = args.index('--format')
+        del args[i:i + 2]
+    if args[:1] == ['ps']:
+        args = ['container', 'ls', *args[1:]]
+    if args[:1] == ['container'] and args[1:2] not in (['ls'], ['inspect'], ['exists']):
+        args = args[1:]
+
+    match args:
+        case ['container', 'ls', *rest]:
+            container_ls(rest)
+        case ['container', 'inspect', *rest] | ['inspect', *rest]:
+            container_inspect(rest)
+        case ['container', 'exists', name]:
+            with locked_state() as state:
+                sys.exit(0 if any(c['Name'] == name for c in state['containers'].values()) else 1)
+        case ['create', *rest]:
+            create(rest)
+        case ['start', *rest] | ['restore', *rest] | ['unpause', *rest]:
+            set_status(rest, 'running')
+        case ['stop', *rest]:
+            set_status(rest, 'exited')
+        case ['checkpoint', *rest]:
+            set_status(rest, 'checkpointed')
+        case ['pause', *rest]:
+            set_status(rest, 'paused')
+        case ['rm', *rest]:
+            rm(rest)
+        case ['rename', old, new]:
+            rename([old, new])
+        case ['commit', *rest]:
+            commit(rest)
+        case ['exec', *rest]:
+            exec_(rest)
+        case ['mount', name]:
+            mount([name])
+        case ['umount', name]:
+            pass
+        case ['diff', name]:
+            diff([name])
+        case ['image', 'ls', *rest] | ['images', *rest]:
+            image_ls(rest)
+        case ['image', 'inspect', *rest]:
+            image_inspect(rest)
+        case ['image', 'rm', *rest] | ['rmi', *rest]:
+            image_rm(rest)
+        case ['pull', *rest]:
+            pull(rest)
+        case ['run', *rest]:
+            # Nothing to run it in, tests look at the arguments in the log
+            pass
+        case _:
+            fail(f'fake podman does not know {args}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
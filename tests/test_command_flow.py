@@ -0,0 +1,403 @@
+# Runs probox against tests/fake_podman.py and checks how many podman processes each command spawns and how
+# long it takes, as that is where the time goes. When a change makes a command slower on purpose, update
+# its budget here.
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+repo = Path(__file__).resolve().parent.parent
+fake_podman = repo / 'tests' / 'fake_podman.py'
+
+# Added to every podman call, about what the real binary needs to start and open its database
+latency = 0.05
+
+
+@unittest.skipUnless(shutil.which('ssh-agent') and Path(f'/run/user/{os.getuid()}').is_dir(), "needs ssh-agent and /run/user/$UID")
+class CommandFlowTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='probox-test-'))
+        self.log = self.tmp / 'podman-calls'
+        self.env = {**os.environ, 'PROBOX_PODMAN': str(fake_podman), 'FAKE_PODMAN_LATENCY': str(latency)}
+        self.env.pop('PROBOX_TRACE', None)
+        for var in ['XDG_CONFIG_HOME', 'XDG_DATA_HOME', 'XDG_CACHE_HOME', 'XDG_RUNTIME_DIR']:
+            self.env[var] = str(self.tmp / var.lower())
+
+        self.overlay = self.tmp / 'overlay'
+        (self.overlay / '.config/tool').mkdir(parents=True)
+        (self.overlay / '.bashrc').write_text('# from the overlay\n')
+        (self.overlay / '.config/tool/settings').write_text('answer = 42\n')
+        config_dir = self.tmp / 'xdg_config_home/probox'
+        config_dir.mkdir(parents=True)
+        (config_dir / 'probox.toml').write_text(f'default_image = "docker.io/library/fake"\nhome_overlay = "{self.overlay}"\n')
+
+        # ssh-agent sockets live in /run/user/$UID, so names have to be unique on this machine
+        self.prefix = f't{os.getpid()}'
+
+    def tearDown(self):
+        for container in json.loads(self.podman('container', 'ls', '--all', '--format', 'json')):
+            self.podman('rm', '--force', container['Names'][0])
+        for pidfile in Path(f'/run/user/{os.getuid()}').glob(f'{self.prefix}-*-ssh.pid'):
+            try:
+                os.kill(int(pidfile.read_text()), 15)
+            except (ValueError, ProcessLookupError):
+                pass
+            pidfile.unlink()
+            Path(str(pidfile).removesuffix('.pid') + '.sock').unlink(missing_ok=True)
+        shutil.rmtree(self.tmp)
+
+    def podman(self, *args):
+        # Straight to the stand-in, without counting
+        return subprocess.run([str(fake_podman), *args], env=self.env, capture_output=True, text=True, check=True).stdout
+
+    def probox(self, *args, returncode=0, input=None):
+        # Returns the podman calls and the wall time of one probox command
+        self.log.unlink(missing_ok=True)
+        start = time.monotonic()
+        res = subprocess.run(
+            [sys.executable, str(repo / 'probox.py'), *args], env={**self.env, 'FAKE_PODMAN_LOG': str(self.log)},
+            input=input or '', capture_output=True, text=True
+        )
+        elapsed = time.monotonic() - start
+        self.assertEqual(res.returncode, returncode, res.stderr)
+        calls = [json.loads(line) for line in self.log.read_text().splitlines()] if self.log.exists() else []
+        return calls, elapsed, res.stdout
+
+    def assertBudget(self, calls, elapsed, max_calls, max_seconds):
+        listing = '\n'.join(' '.join(call)[:120] for call in calls)
+        self.assertLessEqual(len(calls), max_calls, f"{len(calls)} podman calls:\n{listing}")
+        self.assertLessEqual(elapsed, max_seconds, f"took {elapsed:.2f}s with {len(calls)} podman calls:\n{listing}")
+
+    def project(self, name):
+        path = self.tmp / 'projects' / name
+        path.mkdir(parents=True)
+        return path
+
+    def rootfs(self, name):
+        return Path(self.podman('mount', f'{self.prefix}-{name}').strip())
+
+    def home_in_box(self, name):
+        return self.rootfs(name) / str(Path.home()).lstrip('/')
+
+    def create(self, name):
+        return self.probox('create', '--name', f'{self.prefix}-{name}', str(self.project(name)))
+
+    def test_create(self):
+        # The first create pulls the base image and builds the derived one
+        calls, elapsed, _ = self.create('one')
+        self.assertBudget(calls, elapsed, 23, 5.5)
+        self.assertEqual((self.home_in_box('one') / '.config/tool/settings').read_text(), 'answer = 42\n')
+
+        calls, elapsed, _ = self.create('two')
+        self.assertBudget(calls, elapsed, 13, 3.5)
+
+    def test_mount_points(self):
+        # Made by us as the user before the first start, otherwise podman makes them owned by root
+        config_file = self.tmp / 'xdg_config_home/probox/probox.toml'
+        config_file.write_text(config_file.read_text() + '[caches]\npip = "~/.cache/pip"\n')
+        self.create('one')
+        home = self.home_in_box('one')
+        for directory in ['.cache/pip', '.local/share/containers', '.config/tool']:
+            self.assertTrue((home / directory).is_dir(), directory)
+
+    def test_create_existing_path(self):
+        # Refused right away, without looking up (or pulling) the image first
+        self.create('one')
+        calls, elapsed, _ = self.probox('create', str(self.tmp / 'projects/one'), returncode=1)
+        self.assertBudget(calls, elapsed, 0, 0.5)
+
+    def test_create_same_path(self):
+        # Side by side, only one of them gets the path
+        project = self.project('one')
+        creates = [
+            subprocess.Popen([sys.executable, str(repo / 'probox.py'), 'create', '--name', f'{self.prefix}-{name}', str(project)], env=self.env, stderr=subprocess.DEVNULL)
+            for name in ['one', 'two']
+        ]
+        self.assertEqual(sorted(create.wait() for create in creates), [0, 1])
+        self.assertEqual(len(json.loads(self.podman('container', 'ls', '--all', '--format', 'json'))), 1)
+
+    def test_apply(self):
+        manifest = self.tmp / 'boxes.toml'
+        self.project('one')
+        self.project('two')
+        manifest.write_text(f'[[box]]\npath = "projects/one"\nname = "{self.prefix}-one"\n\n[[box]]\npath = "projects/one"\nname = "{self.prefix}-two"\n')
+        self.probox('apply', '--yes', str(manifest), returncode=1)
+        self.assertEqual(json.loads(self.podman('container', 'ls', '--all', '--format', 'json')), [])
+
+        manifest.write_text(manifest.read_text().replace('projects/one"\nname = "' + f'{self.prefix}-two', 'projects/two"\nname = "' + f'{self.prefix}-two'))
+        self.probox('apply', '--yes', str(manifest))
+        self.assertEqual(len(json.loads(self.podman('container', 'ls', '--all', '--format', 'json'))), 2)
+
+    def test_run(self):
+        self.create('one')
+        calls, elapsed, _ = self.probox('run', f'{self.prefix}-one', 'true')
+        self.assertBudget(calls, elapsed, 3, 1.5)
+
+        # Already running
+        calls, elapsed, _ = self.probox('run', f'{self.prefix}-one', 'true')
+        self.assertBudget(calls, elapsed, 2, 1.0)
+
+    def test_temp(self):
+        self.create('one')
+        calls, elapsed, _ = self.probox('temp', str(self.project('two')))
+        self.assertBudget(calls, elapsed, 19, 4.5)
+        self.assertEqual(len(json.loads(self.podman('container', 'ls', '--all', '--format', 'json'))), 1)
+
+    def test_overlay_push(self):
+        self.create('one')
+        (self.overlay / '.bashrc').write_text('# changed on the host\n')
+        calls, elapsed, _ = self.probox('overlay', 'push', f'{self.prefix}-one')
+        self.assertBudget(calls, elapsed, 6, 2.0)
+        self.assertEqual((self.home_in_box('one') / '.bashrc').read_text(), '# changed on the host\n')
+
+        # Nothing changed, nothing to hash or transfer
+        calls, elapsed, _ = self.probox('overlay', 'push', f'{self.prefix}-one')
+        self.assertBudget(calls, elapsed, 3, 1.2)
+
+        self.probox('start', f'{self.prefix}-one')
+        (self.overlay / '.bashrc').write_text('# changed again\n')
+        calls, elapsed, _ = self.probox('overlay', 'push', f'{self.prefix}-one')
+        self.assertBudget(calls, elapsed, 3, 1.2)
+        self.assertEqual((self.home_in_box('one') / '.bashrc').read_text(), '# changed again\n')
+
+    def test_overlay_push_symlink(self):
+        # A link in a stopped box points at a box path, not at the host's
+        self.create('one')
+        host_dir = self.tmp / 'host-dir'
+        host_dir.mkdir()
+        shutil.rmtree(self.home_in_box('one') / '.config')
+        (self.home_in_box('one') / '.config').symlink_to(host_dir)
+        (self.overlay / '.config/tool/settings').write_text('answer = 43\n')
+        subprocess.run([sys.executable, str(repo / 'probox.py'), 'overlay', 'push', f'{self.prefix}-one'], env=self.env, capture_output=True)
+        self.assertEqual(list(host_dir.iterdir()), [])
+
+    def test_overlay_pull_bulk(self):
+        self.create('one')
+        self.create('two')
+        for name in ['one', 'two']:
+            (self.home_in_box(name) / '.bashrc').write_text(f'# changed in {name}\n')
+        self.probox('overlay', 'pull', '--all', returncode=1)
+        self.assertIn((self.overlay / '.bashrc').read_text(), ['# changed in one\n', '# changed in two\n'])
+
+    def test_overlay_mount(self):
+        config_file = self.tmp / 'xdg_config_home/probox/probox.toml'
+        config_file.write_text('overlay_mode = "mount"\n' + config_file.read_text())
+        self.create('one')
+        self.probox('start', f'{self.prefix}-one')
+        (self.overlay / '.bashrc').write_text('# edited in place\n')
+        res = subprocess.run([sys.executable, str(repo / 'probox.py'), 'overlay', 'push', f'{self.prefix}-one'], env=self.env, capture_output=True, text=True)
+        self.assertNotIn('restart it', res.stderr)
+        self.assertEqual((self.home_in_box('one') / '.bashrc').read_text(), '# edited in place\n')
+
+        # Saved like most editors do, the box still sees the old file
+        (self.overlay / '.bashrc.new').write_text('# saved by an editor\n')
+        (self.overlay / '.bashrc.new').rename(self.overlay / '.bashrc')
+        res = subprocess.run([sys.executable, str(repo / 'probox.py'), 'overlay', 'push', f'{self.prefix}-one'], env=self.env, capture_output=True, text=True)
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertRegex(res.stderr, r'restart it to see the new versions:.* \.bashrc')
+
+    def test_overlay_large(self):
+        # Hundreds of files still go in one tar stream, so the number of calls doesn't grow with them
+        files = [Path(f'.config/many/{i % 10}/{i}') for i in range(300)]
+        for file in files:
+            (self.overlay / file).parent.mkdir(parents=True, exist_ok=True)
+            (self.overlay / file).write_text(f'{file.name}\n' * 100)
+        self.create('one')
+        home = self.home_in_box('one')
+
+        for file in files:
+            (self.overlay / file).write_text(f'{file.name} on the host\n')
+        calls, elapsed, _ = self.probox('overlay', 'push', f'{self.prefix}-one')
+        self.assertBudget(calls, elapsed, 6, 2.0)
+        self.assertTrue(all((home / file).read_text() == f'{file.name} on the host\n' for file in files))
+
+        for file in files:
+            (home / file).write_text(f'{file.name} in the box\n')
+        calls, elapsed, _ = self.probox('overlay', 'pull', f'{self.prefix}-one')
+        self.assertBudget(calls, elapsed, 9, 2.5)
+        self.assertTrue(all((self.overlay / file).read_text() == f'{file.name} in the box\n' for file in files))
+
+    def test_overlay_pull(self):
+        self.create('one')
+        script = self.home_in_box('one') / '.local/bin/tool'
+        script.parent.mkdir(parents=True)
+        script.write_text('#!/bin/sh\n')
+        script.chmod(0o750)
+        calls, elapsed, _ = self.probox('overlay', 'pull', f'{self.prefix}-one', '.local/bin/tool')
+        self.assertBudget(calls, elapsed, 9, 2.5)
+        self.assertEqual((self.overlay / '.local/bin/tool').read_text(), '#!/bin/sh\n')
+        self.assertEqual((self.overlay / '.local/bin/tool').stat().st_mode & 0o777, 0o750)
+
+    def test_snapshot_project(self):
+        self.create('one')
+        project = self.tmp / 'projects/one'
+        (project / 'file').write_text('before\n')
+        self.probox('snapshot', 'create', f'{self.prefix}-one')
+        (project / 'file').write_text('after\n')
+        self.probox('snapshot', 'restore', f'{self.prefix}-one', input='n\n')
+        self.assertEqual((project / 'file').read_text(), 'after\n')
+        self.probox('snapshot', 'restore', f'{self.prefix}-one', input='y\n')
+        self.assertEqual((project / 'file').read_text(), 'before\n')
+
+        # Like a box for the home directory, which holds the snapshots
+        config_file = self.tmp / 'xdg_config_home/probox/probox.toml'
+        config_file.write_text(config_file.read_text() + f'snapshot_dir = "{project / "snapshots"}"\n')
+        self.probox('snapshot', 'create', f'{self.prefix}-one', returncode=1)
+        self.probox('snapshot', 'create', f'{self.prefix}-one', '--no-project')
+        self.assertEqual(sorted(p.name for p in (project / f'snapshots/{self.prefix}-one').iterdir())[0][:2], '20')
+
+    def test_upgrade(self):
+        config_file = self.tmp / 'xdg_config_home/probox/probox.toml'
+        config_file.write_text(config_file.read_text() + 'exec_agent = true\n')
+        self.create('one')
+        config_file.write_text(config_file.read_text().replace('exec_agent = true\n', ''))
+        root = self.rootfs('one')
+        for package, reason in [('tool', ''), ('libtool', '%REASON%\n1\n')]:
+            (root / f'var/lib/pacman/local/{package}-1.0-1').mkdir(parents=True)
+            (root / f'var/lib/pacman/local/{package}-1.0-1/desc').write_text(f'%NAME%\n{package}\n\n%VERSION%\n1.0-1\n\n{reason}')
+        (root / 'usr/bin').mkdir(parents=True)
+        (root / 'usr/bin/tool').write_text('binary\n')
+        (root / 'etc').mkdir()
+        (root / 'etc/tool.conf').write_text('setting\n')
+
+        res = subprocess.run(
+            [sys.executable, str(repo / 'probox.py'), 'upgrade', f'{self.prefix}-one'], env=self.env, stdin=subprocess.DEVNULL, capture_output=True, text=True
+        )
+        self.assertEqual(res.returncode, 0, res.stderr)
+        # Only the explicitly installed one
+        self.assertRegex(res.stderr, r'pacman -S --needed tool\x1b')
+        dropped = (self.tmp / f'xdg_data_home/probox/{self.prefix}-one-upgrade-dropped.txt').read_text().split()
+        self.assertIn('/usr/bin/tool', dropped)
+
+        root = self.rootfs('one')
+        self.assertEqual((root / 'etc/tool.conf').read_text(), 'setting\n')
+        self.assertFalse((root / 'usr/bin/tool').exists())
+        # Kept from the old box, even though the config doesn't ask for it anymore
+        box = json.loads(self.podman('container', 'inspect', f'{self.prefix}-one'))[0]
+        self.assertIn('probox.exec_agent', box['Config']['Labels'])
+
+    def test_upgrade_keep_old(self):
+        self.create('one')
+        subprocess.run([sys.executable, str(repo / 'probox.py'), 'upgrade', '--keep-old', f'{self.prefix}-one'], env=self.env, stdin=subprocess.DEVNULL, capture_output=True, check=True)
+        # Both have the path, which stands for the new one
+        _, _, stdout = self.probox('name', str(self.tmp / 'projects/one'))
+        self.assertEqual(stdout.strip(), f'{self.prefix}-one')
+
+    def test_upgrade_symlink(self):
+        # A deleted path under a link in the box is deleted in the new box, not on the host
+        self.create('one')
+        host_dir = self.tmp / 'host-dir'
+        host_dir.mkdir()
+        (host_dir / 'f').write_text('keep\n')
+        (self.rootfs('one') / 'opt').mkdir()
+        (self.rootfs('one') / 'opt/d').symlink_to(host_dir)
+        box_id = json.loads(self.podman('container', 'inspect', f'{self.prefix}-one'))[0]['Id']
+        (self.tmp / 'xdg_data_home/containers/storage/fake-deleted').mkdir()
+        (self.tmp / f'xdg_data_home/containers/storage/fake-deleted/{box_id}').write_text('/opt/d/f\n')
+        res = subprocess.run(
+            [sys.executable, str(repo / 'probox.py'), 'upgrade', f'{self.prefix}-one'], env=self.env, stdin=subprocess.DEVNULL, capture_output=True, text=True
+        )
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertTrue((self.rootfs('one') / 'opt/d').is_symlink())
+        self.assertEqual((host_dir / 'f').read_text(), 'keep\n')
+
+    def test_store_pull(self):
+        # Through a box with the boxes' ID mapping, not the host's podman
+        config_file = self.tmp / 'xdg_config_home/probox/probox.toml'
+        config_file.write_text('pinp_image_store = true\n' + config_file.read_text())
+        calls, _, _ = self.probox('store', 'pull', 'docker.io/library/alpine')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][:3], ['run', '--rm', '--userns=keep-id'])
+        self.assertEqual(calls[0][-5:], ['podman', '--root', '/var/lib/shared', 'pull', 'docker.io/library/alpine'])
+
+    def test_pool(self):
+        config_file = self.tmp / 'xdg_config_home/probox/probox.toml'
+        config_file.write_text(config_file.read_text() + '[temp_pool]\nsize = 0\n')
+        self.create('one')
+        self.probox('start', f'{self.prefix}-one')
+        # Left behind by a reboot: stopped, without staging directory or claim marker
+        for name in [f'{self.prefix}-pool1', f'{self.prefix}-pool2']:
+            self.podman(
+                'create', '--name', name, '--label', 'probox.pool=docker.io/library/fake',
+                '--label', f'probox.project_path={self.tmp}/xdg_runtime_dir/probox/pool/{name}', 'docker.io/library/fake'
+            )
+        self.podman('start', f'{self.prefix}-pool2')
+
+        # Bulk commands leave pool boxes alone
+        self.probox('stop', '--all')
+        boxes = {c['Names'][0]: c['State'] for c in json.loads(self.podman('container', 'ls', '--all', '--format', 'json'))}
+        self.assertEqual(boxes[f'{self.prefix}-one'], 'exited')
+        self.assertEqual(boxes[f'{self.prefix}-pool2'], 'running')
+
+        self.probox('pool', 'fill')
+        boxes = [c['Names'][0] for c in json.loads(self.podman('container', 'ls', '--all', '--format', 'json'))]
+        self.assertEqual(boxes, [f'{self.prefix}-one'])
+
+        self.podman('create', '--name', f'{self.prefix}-pool3', '--label', 'probox.pool=docker.io/library/fake', '--label', 'probox.project_path=/nonexistent', 'docker.io/library/fake')
+        shutil.rmtree(self.tmp / 'xdg_runtime_dir')
+        self.probox('pool', 'clear')
+        boxes = [c['Names'][0] for c in json.loads(self.podman('container', 'ls', '--all', '--format', 'json'))]
+        self.assertEqual(boxes, [f'{self.prefix}-one'])
+
+    def test_du_after_push(self):
+        self.create('one')
+        size = lambda stdout: next(line.split()[1] for line in stdout.splitlines() if line.startswith(f'{self.prefix}-one '))
+        before = size(self.probox('du', '--refresh')[2])
+        # The box's state doesn't change, but its writable layer does
+        (self.overlay / 'big').write_bytes(bytes(4 << 20))
+        self.probox('overlay', 'push', f'{self.prefix}-one')
+        after = size(self.probox('du', '--refresh')[2])
+        self.assertNotEqual(before, after)
+
+    def test_stop_paused(self):
+        self.create('one')
+        self.create('two')
+        for name in ['one', 'two']:
+            self.probox('start', f'{self.prefix}-{name}')
+            self.podman('pause', f'{self.prefix}-{name}')
+        self.probox('stop', f'{self.prefix}-one')
+        self.probox('stop', '--checkpoint', f'{self.prefix}-two')
+        boxes = json.loads(self.podman('container', 'inspect', f'{self.prefix}-one', f'{self.prefix}-two'))
+        self.assertEqual([box['State']['Status'] for box in boxes], ['exited', 'exited'])
+        self.assertEqual([box['State']['Checkpointed'] for box in boxes], [False, True])
+
+    def test_idle_exec_agent(self):
+        config_file = self.tmp / 'xdg_config_home/probox/probox.toml'
+        config_file.write_text('exec_agent = true\nidle_timeout = 1\nidle_cpu_percent = 100000\n' + config_file.read_text())
+        self.create('one')
+        self.probox('start', f'{self.prefix}-one')
+        # Stands in for the agent, which the box runs as a detached exec for as long as it's up
+        agent_id = self.podman('exec', '-d', f'{self.prefix}-one', 'sleep', '60').strip()
+        agents_dir = self.tmp / 'xdg_runtime_dir/probox/exec-agents'
+        (agents_dir / f'{self.prefix}-one.id').write_text(agent_id)
+        # A `probox run` through the agent
+        with open(agents_dir / f'{self.prefix}-one.sessions', 'w') as sessions:
+            fcntl.flock(sessions, fcntl.LOCK_SH)
+            self.probox('idle')
+            time.sleep(1.2)
+            self.probox('idle')
+            box = json.loads(self.podman('container', 'inspect', f'{self.prefix}-one'))[0]
+            self.assertEqual(box['State']['Status'], 'running')
+        time.sleep(1.2)
+        self.probox('idle')
+        box = json.loads(self.podman('container', 'inspect', f'{self.prefix}-one'))[0]
+        self.assertEqual(box['State']['Status'], 'exited')
+
+    def test_ports(self):
+        self.create('one')
+        self.create('two')
+        self.probox('start', f'{self.prefix}-one')
+        self.probox('start', f'{self.prefix}-two')
+        calls, elapsed, stdout = self.probox('ports')
+        self.assertBudget(calls, elapsed, 2, 1.0)
+        self.assertIn(f'- {self.prefix}-one', stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# Runs the exec agent on the host, on a socket of its own, and streams through it the way `probox run` does.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+repo = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo))
+import probox  # noqa: E402
+
+# Runs a command through the agent at argv[1], with our stdin and stdout
+client = '''
+import sys
+import probox
+probox.exec_agent_socket = lambda name: sys.argv[1]
+sys.exit(probox.exec_agent_run('box', sys.argv[2:], {}, '/', use_pty=False))
+'''
+
+
+class ExecAgentTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='probox-test-'))
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.socket = self.tmp / 'exec.sock'
+        agent = subprocess.Popen([sys.executable, '-c', probox.exec_agent_code, str(self.socket)])
+        self.addCleanup(agent.wait)
+        self.addCleanup(agent.terminate)
+        for i in range(100):
+            if probox.socket_alive(self.socket):
+                break
+            time.sleep(0.05)
+        self.env = {**os.environ, 'PYTHONPATH': str(repo), 'XDG_RUNTIME_DIR': str(self.tmp / 'runtime')}
+
+    def run_client(self, *cmd, input=b''):
+        return subprocess.run([sys.executable, '-c', client, str(self.socket), *cmd], input=input, capture_output=True, env=self.env, timeout=30)
+
+    def test_stream(self):
+        # More than the pipes and socket buffers hold, so both ends have to keep reading while they write
+        data = os.urandom(8 << 20)
+        res = self.run_client('cat', input=data)
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertEqual(res.stdout, data)
+
+    def test_exit_code(self):
+        res = self.run_client('sh', '-c', 'echo out; echo err >&2; exit 3')
+        self.assertEqual((res.returncode, res.stdout, res.stderr), (3, b'out\n', b'err\n'))
+
+    def test_unread_input(self):
+        # The command exits without reading its input
+        res = self.run_client('true', input=os.urandom(1 << 20))
+        self.assertEqual(res.returncode, 0, res.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# Checks that the podman service (podman_socket) gives probox the same data as the podman binary, and that
+# probox falls back to the binary when the service can't answer. The service is played by a small HTTP
+# server on a unix socket, serving what tests/fake_podman.py prints for the same query.
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from pathlib import Path
+from unittest import mock
+
+repo = Path(__file__).resolve().parent.parent
+fake_podman = repo / 'tests' / 'fake_podman.py'
+sys.path.insert(0, str(repo))
+import probox  # noqa: E402
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the podman service
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        if 'filters' in params:
+            params['filters'] = json.loads(params['filters'])
+        self.server.requests.append((url.path, params))
+        body = next((body for path, p, body in self.server.canned if (path, p) == (url.path, params)), None)
+        code = 200 if body is not None and url.path not in self.server.failing else 500 if body is not None else 404
+        data = (body if code == 200 else json.dumps({'cause': 'canned', 'response': code})).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Service(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # http.server wants a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('localhost', 0)
+
+
+class PodmanApiTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='probox-test-'))
+        env = mock.patch.dict(os.environ, {'XDG_DATA_HOME': str(self.tmp / 'data'), 'XDG_RUNTIME_DIR': str(self.tmp / 'runtime')})
+        env.start()
+        self.addCleanup(env.stop)
+        for attribute, value in [('podman_binary', str(fake_podman)), ('podman_api', threading.local()), ('config', {'podman_socket': str(self.tmp / 'podman.sock')})]:
+            patch = mock.patch.object(probox, attribute, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        image_id = self.podman('pull', 'docker.io/library/fake').strip()
+        self.podman('create', '--name', 'box', '--label', f'probox.project_path={self.tmp}', '--volume', f'{self.tmp}:{self.tmp}:Z', 'docker.io/library/fake')
+        self.podman('create', '--name', 'other', 'docker.io/library/fake')
+        # The queries probox makes, with the request the service should get for them
+        self.queries = [
+            (('container', 'ls', '--all', '--filter', 'label=probox.project_path'), '/v4.0.0/libpod/containers/json', {'all': 'true', 'filters': {'label': ['probox.project_path']}}),
+            (('image', 'ls', '--all', 'docker.io/library/fake'), '/v4.0.0/libpod/images/json', {'all': 'true', 'filters': {'reference': ['docker.io/library/fake']}}),
+            (('image', 'ls', '--all', '--filter', 'label=probox.setup_user'), '/v4.0.0/libpod/images/json', {'all': 'true', 'filters': {'label': ['probox.setup_user']}}),
+            (('container', 'inspect', 'box'), '/v4.0.0/libpod/containers/box/json', {}),
+            (('image', 'inspect', image_id), f'/v4.0.0/libpod/images/{image_id}/json', {}),
+        ]
+
+        self.service = Service(str(self.tmp / 'podman.sock'), ServiceHandler)
+        self.service.requests, self.service.failing = [], set()
+        # The service answers inspect with the object itself, the binary with a list
+        self.service.canned = [
+            (path, params, json.dumps(self.binary(args)[0] if 'inspect' in args else self.binary(args)))
+            for args, path, params in self.queries
+        ]
+        threading.Thread(target=self.service.serve_forever, daemon=True).start()
+        self.addCleanup(self.service.server_close)
+        self.addCleanup(self.service.shutdown)
+
+    def tearDown(self):
+        self.podman('rm', '--force', 'box', 'other')
+        shutil.rmtree(self.tmp)
+
+    def podman(self, *args):
+        return subprocess.run([str(fake_podman), *args], capture_output=True, text=True, check=True).stdout
+
+    def binary(self, args):
+        return json.loads(self.podman(*args, '--format', 'json'))
+
+    def test_parity(self):
+        for args, path, params in self.queries:
+            with self.subTest(args=args):
+                self.assertEqual(probox.capture_podman(*args), self.binary(args))
+        self.assertEqual(self.service.requests, [(path, params) for args, path, params in self.queries])
+
+    def test_connection_reused(self):
+        probox.capture_podman('container', 'ls', '--all', '--filter', 'label=probox.project_path')
+        connection = probox.podman_api.connection
+        probox.capture_podman('container', 'inspect', 'box')
+        self.assertIs(probox.podman_api.connection, connection)
+
+    def test_fallback_on_error(self):
+        # The binary gives the proper error (or data), so a non-200 answer falls back to it
+        self.service.failing.add('/v4.0.0/libpod/containers/json')
+        args = ('container', 'ls', '--all', '--filter', 'label=probox.project_path')
+        self.assertEqual(probox.capture_podman(*args), self.binary(args))
+        self.assertEqual(len(self.service.requests), 1)
+        with self.assertRaises(subprocess.CalledProcessError):
+            probox.capture_podman('container', 'inspect', 'missing')
+        self.assertEqual(self.service.requests[-1][0], '/v4.0.0/libpod/containers/missing/json')
+
+    def test_fallback_on_unsupported(self):
+        # Options the translation doesn't know go straight to the binary
+        self.assertEqual(probox.capture_podman('container', 'ls', '--all', '--sort', 'names'), self.binary(('container', 'ls', '--all')))
+        self.assertEqual(self.service.requests, [])
+
+    def test_fallback_without_service(self):
+        self.service.shutdown()
+        self.service.server_close()
+        os.unlink(self.tmp / 'podman.sock')
+        args = ('container', 'ls', '--all', '--filter', 'label=probox.project_path')
+        with mock.patch.object(probox, 'status'):
+            self.assertEqual(probox.capture_podman(*args), self.binary(args))
+        # Not tried again for the next queries
+        self.assertTrue(probox.podman_api.disabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# Checks the token cache and refresh-token rotation against a stand-in OAuth endpoint, which (like
+# DigitalOcean's) only accepts each refresh token once.
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+from pathlib import Path
+from unittest import mock
+
+repo = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo))
+import probox  # noqa: E402
+
+
+class TokenHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        fields = dict(urllib.parse.parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+        server = self.server
+        with server.lock:
+            server.requests.append(fields)
+            if (fields.get('grant_type'), fields.get('client_id'), fields.get('client_secret')) != ('refresh_token', 'id', 'secret'):
+                code, data = 401, {'error': 'invalid_client'}
+            elif fields.get('refresh_token') != server.refresh_token:
+                code, data = 400, {'error': 'invalid_grant', 'error_description': 'refresh token was already used'}
+            else:
+                n = len(server.requests)
+                server.refresh_token = f'refresh-{n}'
+                code, data = 200, {'access_token': f'access-{n}', 'refresh_token': server.refresh_token, 'expires_in': server.expires_in}
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TokenTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix='probox-test-'))
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.env = {'XDG_RUNTIME_DIR': str(self.tmp / 'runtime'), 'XDG_CONFIG_HOME': str(self.tmp / 'config')}
+        patch = mock.patch.dict(os.environ, self.env)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.endpoint = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TokenHandler)
+        self.endpoint.lock, self.endpoint.requests = threading.Lock(), []
+        self.endpoint.refresh_token, self.endpoint.expires_in = 'refresh-0', 3600
+        threading.Thread(target=self.endpoint.serve_forever, daemon=True).start()
+        self.addCleanup(self.endpoint.server_close)
+        self.addCleanup(self.endpoint.shutdown)
+
+        self.secrets_file = self.tmp / 'digitalocean.secrets.json'
+        self.secrets_file.write_text(json.dumps({'CLIENT_ID': 'id', 'CLIENT_SECRET': 'secret', 'REFRESH_TOKEN': 'refresh-0'}))
+        self.settings = {
+            'provider': 'digitalocean', 'boxes': ['web-*'], 'secrets_file': str(self.secrets_file),
+            'token_url': f'http://127.0.0.1:{self.endpoint.server_port}/v1/oauth/token',
+        }
+        patch = mock.patch.object(probox, 'config', {'tokens': {'do': self.settings}})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def saved_refresh_token(self):
+        return json.loads(self.secrets_file.read_text())['REFRESH_TOKEN']
+
+    def test_cache_hit(self):
+        self.assertEqual(probox.get_token('do')['token'], 'access-1')
+        self.assertEqual(probox.get_token('do')['token'], 'access-1')
+        self.assertEqual(len(self.endpoint.requests), 1)
+        self.assertEqual(self.saved_refresh_token(), 'refresh-1')
+        self.assertEqual(self.secrets_file.stat().st_mode & 0o777, 0o600)
+        self.assertEqual(probox.token_cache_file('do').stat().st_mode & 0o777, 0o600)
+
+    def test_rotation(self):
+        # Expiring within refresh_margin, so every get refreshes, each time with the token of the last refresh
+        self.endpoint.expires_in = 200
+        for n in range(1, 4):
+            self.assertEqual(probox.get_token('do')['token'], f'access-{n}')
+            self.assertEqual(self.endpoint.requests[-1]['refresh_token'], f'refresh-{n - 1}')
+            self.assertEqual(self.saved_refresh_token(), f'refresh-{n}')
+
+    def test_refresh_near_expiry(self):
+        expires = probox.get_token('do')['expires']
+        # Just outside and just within refresh_margin of the expiry
+        with mock.patch.object(probox.time, 'time', lambda: expires - 301):
+            self.assertEqual(probox.get_token('do')['token'], 'access-1')
+        with mock.patch.object(probox.time, 'time', lambda: expires - 299):
+            self.assertEqual(probox.get_token('do')['token'], 'access-2')
+        self.assertEqual(len(self.endpoint.requests), 2)
+
+    def test_concurrent(self):
+        # Parallel boxes asking at once must not refresh twice, the second refresh would use a spent token
+        with probox.concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            tokens = list(pool.map(lambda i: probox.get_token('do')['token'], range(8)))
+        self.assertEqual(tokens, ['access-1'] * 8)
+        self.assertEqual(len(self.endpoint.requests), 1)
+
+    def test_failed_refresh(self):
+        self.endpoint.refresh_token = 'something else'
+        with self.assertRaisesRegex(RuntimeError, 'invalid_grant'):
+            probox.get_token('do')
+        self.assertEqual(self.saved_refresh_token(), 'refresh-0')
+        self.assertFalse(probox.token_cache_file('do').exists())
+
+    @unittest.skipUnless(Path(f'/run/user/{os.getuid()}').is_dir(), "needs /run/user/$UID")
+    def test_broker(self):
+        config_dir = self.tmp / 'config/probox'
+        config_dir.mkdir(parents=True)
+        (config_dir / 'probox.toml').write_text('[tokens.do]\n' + ''.join(f'{k} = {json.dumps(v)}\n' for k, v in self.settings.items()))
+        name = f'web-t{os.getpid()}'
+        broker = subprocess.Popen([sys.executable, str(repo / 'probox.py'), 'token', 'serve', name], env={**os.environ, **self.env}, stderr=subprocess.DEVNULL)
+        self.addCleanup(broker.wait)
+        self.addCleanup(broker.terminate)
+        sock = probox.token_broker_socket(name)
+        for i in range(100):
+            if probox.socket_alive(sock):
+                break
+            time.sleep(0.05)
+
+        def get(path):
+            connection = probox.UnixHTTPConnection(str(sock))
+            connection.request('GET', path)
+            response = connection.getresponse()
+            return response.status, response.read()
+
+        self.assertEqual(get('/do'), (200, b'access-1\n'))
+        self.assertEqual(get('/do'), (200, b'access-1\n'))
+        self.assertEqual(get('/other')[0], 404)
+        self.assertEqual(len(self.endpoint.requests), 1)
+
+        broker.terminate()
+        broker.wait()
+        self.assertFalse(sock.exists())
+        probox.token_broker_pidfile(name).unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+    unittest.main()